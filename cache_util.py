@@ -0,0 +1,151 @@
+import os, hashlib, tempfile
+import cPickle as pickle
+from collections import OrderedDict
+from functools import wraps
+from multiprocessing.managers import BaseManager
+import numpy as np
+
+
+class LRUCache(object):
+    '''
+    A mapping that holds at most maxsize items, evicting the
+    least recently used item when a new item is added.
+    '''
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self.items = OrderedDict()
+
+    def __len__(self):
+        return len(self.items)
+
+    def __contains__(self, key):
+        return key in self.items
+
+    def __getitem__(self, key):
+        value = self.items.pop(key)
+        self.items[key] = value # mark as most recently used
+        return value
+
+    def __setitem__(self, key, value):
+        self.items.pop(key, None)
+        self.items[key] = value
+        while len(self.items) > self.maxsize:
+            self.items.popitem(last=False)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def pop(self, key, default=None):
+        return self.items.pop(key, default)
+
+    def clear(self):
+        self.items.clear()
+
+
+def lru_cache(maxsize=128):
+    '''
+    Decorator that memoizes a function of hashable positional
+    arguments in an LRUCache with at most maxsize items.
+    '''
+    def decorator(func):
+        cache = LRUCache(maxsize)
+
+        @wraps(func)
+        def wrapper(*args):
+            try:
+                return cache[args]
+            except KeyError:
+                value = cache[args] = func(*args)
+                return value
+
+        wrapper.cache = cache
+        return wrapper
+
+    return decorator
+
+
+def read_only(array):
+    '''
+    Mark a numpy array as read-only so that it can be
+    safely shared from a cache, and return it.
+    '''
+    array.flags.writeable = False
+    return array
+
+
+class DiskCache(object):
+    '''
+    A mapping from string keys to values that are pickled to files in
+    a directory, so that it can be shared between processes and runs.
+    '''
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+    def get_file(self, key):
+        return os.path.join(self.cache_dir, key + '.pkl')
+
+    def __contains__(self, key):
+        return os.path.isfile(self.get_file(key))
+
+    def __getitem__(self, key):
+        try:
+            with open(self.get_file(key), 'rb') as f:
+                return pickle.load(f)
+        except IOError:
+            raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        fd, temp_file = tempfile.mkstemp(dir=self.cache_dir)
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(value, f, pickle.HIGHEST_PROTOCOL)
+        os.rename(temp_file, self.get_file(key)) # atomic, so readers never see partial files
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+
+class CacheManager(BaseManager):
+    '''
+    Manager of an LRUCache in a server process that can be
+    shared between processes through a proxy.
+    '''
+    pass
+
+CacheManager.register('LRUCache', LRUCache, exposed=(
+    '__len__', '__contains__', '__getitem__', '__setitem__', 'get', 'pop', 'clear'
+))
+
+
+def hash_values(*values):
+    '''
+    Return a hex digest of the values, hashing numpy arrays by their
+    dtype, shape and bytes, containers by their items, and any other
+    values by their repr.
+    '''
+    hash_ = hashlib.sha1()
+    def update(value):
+        if isinstance(value, np.ndarray):
+            hash_.update(repr((value.dtype.str, value.shape)))
+            hash_.update(np.ascontiguousarray(value).data)
+        elif isinstance(value, dict):
+            hash_.update('dict')
+            for k in sorted(value):
+                update(k)
+                update(value[k])
+        elif isinstance(value, (list, tuple)) and not hasattr(value, '_fields'):
+            hash_.update(type(value).__name__)
+            for v in value:
+                update(v)
+        else:
+            hash_.update(repr(value))
+    for value in values:
+        update(value)
+    return hash_.hexdigest()
@@ -2,10 +2,14 @@ import sys, os
 from collections import Counter
 
 from atom_types import get_default_lig_channels
-from generate import read_gninatypes_file
+from generate import read_gninatypes_file, load_gninatypes_store
 
 channels = get_default_lig_channels(False)
-data_file, data_root = sys.argv[1:]
+data_file, data_root = sys.argv[1:3]
+if len(sys.argv) > 3: # optional prefix of packed ligand atoms
+    lig_store = load_gninatypes_store(sys.argv[3], data_root)
+else:
+    lig_store = None
 
 with open(data_file, 'r') as f:
     lines = f.readlines()
@@ -14,7 +18,7 @@ cnt = Counter()
 for line in lines:
     fields = line.rstrip().split()
     lig_file = os.path.join(data_root, fields[3])
-    xyz, c = read_gninatypes_file(lig_file, channels)
+    xyz, c = read_gninatypes_file(lig_file, channels, lig_store)
     cnt.update(c)
 
 n = 0
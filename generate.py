@@ -1,21 +1,25 @@
 from __future__ import print_function
-import sys, os, re, argparse, time, glob, struct, time
+import sys, os, re, argparse, time, glob, time
 import datetime as dt
 import numpy as np
 import pandas as pd
 import scipy as sp
-from collections import defaultdict, Counter
+from collections import defaultdict, Counter, namedtuple
 import multiprocessing as mp
 import threading
 import contextlib
 import tempfile
 from itertools import izip
 from functools import partial
-from scipy.stats import multivariate_normal
+from scipy.special import logsumexp
+from scipy.ndimage import maximum_filter
+from scipy.spatial import cKDTree
+from scipy.optimize import minimize
 import caffe
 import openbabel as ob
 import pybel
 import caffe_util
+import cache_util
 import atom_types
 pd.set_option('display.width', 250)
 
@@ -56,6 +60,140 @@ def get_atom_gradient(atom_pos, atom_radius, points, radius_multiple):
     return -diff * np.where(zero_cond, 0.0, np.where(gauss_cond, gauss_val, quad_val) / dist)[:,np.newaxis]
 
 
+def get_atom_gradient2(atom_pos, atom_radius, points, radius_multiple):
+    '''
+    Compute the derivative of an atom's Gaussian density with
+    respect to its position at a set of points.
+    '''
+    diff = points - atom_pos
+    return 4*diff/atom_radius**2 * get_atom_density2(atom_pos, atom_radius, points, radius_multiple)[:,np.newaxis]
+
+
+def get_atom_density2_separable(atom_pos, atom_radius, axes):
+    '''
+    Compute the Gaussian density value of an atom at the points of a
+    rectilinear grid, given by its coordinates along each axis, as an
+    outer product of 1D Gaussians.
+    '''
+    gauss = [np.exp(-2*(x - a)**2/atom_radius**2) for x, a in zip(axes, atom_pos)]
+    return reduce(np.multiply.outer, gauss).ravel()
+
+
+def get_atom_density_and_gradient(atom_pos, atom_radius, points, radius_multiple,
+                                  density=None, gradient=None):
+    '''
+    Compute the density value of an atom at a set of points and its derivative
+    with respect to the atom position in a single pass over the distances.
+    Optionally write the results to preallocated density and gradient arrays.
+    Leading dimensions of points broadcast with atom_pos and atom_radius, so
+    that a batch of atoms can be evaluated at once.
+    '''
+    if density is None:
+        density = np.empty(points.shape[:-1])
+    if gradient is None:
+        gradient = np.empty(points.shape)
+    np.subtract(points, atom_pos, out=gradient)
+    dist2 = np.einsum('...i,...i->...', gradient, gradient)
+    dist = np.sqrt(dist2)
+    h = np.broadcast_to(0.5*np.asarray(atom_radius), dist.shape)
+    ie2 = np.exp(-2)
+    gauss_cond = dist <= 2*h
+    quad_cond = ~gauss_cond & (dist < radius_multiple * 2*h)
+    gauss_h = h[gauss_cond]
+    gauss_val = np.exp(-dist2[gauss_cond] / (2*gauss_h**2))
+    quad_h = h[quad_cond]
+    quad_dist = dist[quad_cond]
+    d_density = np.zeros(dist.shape) # derivative w.r.t. distance, over distance
+    density[...] = 0.0
+    density[gauss_cond] = gauss_val
+    density[quad_cond] = dist2[quad_cond]*ie2/(quad_h**2) - 6*quad_dist*ie2/quad_h + 9*ie2
+    d_density[gauss_cond] = gauss_val/gauss_h**2
+    d_density[quad_cond] = 6*ie2/(quad_h*quad_dist) - 2*ie2/(quad_h**2)
+    gradient *= d_density[...,np.newaxis]
+    return density, gradient
+
+
+def get_atom_density_and_gradient2(atom_pos, atom_radius, points, radius_multiple,
+                                   density=None, gradient=None):
+    '''
+    Compute the Gaussian density value of an atom at a set of points and its
+    derivative with respect to the atom position in a single pass. Optionally
+    write the results to preallocated density and gradient arrays. Leading
+    dimensions of points broadcast with atom_pos and atom_radius.
+    '''
+    if density is None:
+        density = np.empty(points.shape[:-1])
+    if gradient is None:
+        gradient = np.empty(points.shape)
+    atom_radius = np.asarray(atom_radius)
+    np.subtract(points, atom_pos, out=gradient)
+    density[...] = np.exp(-2*np.einsum('...i,...i->...', gradient, gradient)/atom_radius**2)
+    gradient *= (4*density/atom_radius**2)[...,np.newaxis]
+    return density, gradient
+
+
+def get_atom_density_and_gradient2_separable(atom_pos, atom_radius, axes, density=None, gradient=None):
+    '''
+    Compute the Gaussian density value of an atom and its derivative with
+    respect to the atom position at the points of a rectilinear grid, given
+    by its coordinates along each axis, as outer products of 1D Gaussians
+    and their derivatives. Optionally write the results to preallocated
+    density and gradient arrays. Leading dimensions of the axes broadcast
+    with atom_pos and atom_radius, so that a batch of atoms can be evaluated
+    at once, each on its own grid.
+    '''
+    n_axes = len(axes)
+    atom_radius = np.asarray(atom_radius)[...,np.newaxis]
+    gauss = []
+    d_gauss = []
+    for i, x in enumerate(axes):
+        x = x - atom_pos[...,i,np.newaxis]
+        g = np.exp(-2*x**2/atom_radius**2)
+        expand = (Ellipsis,) + (np.newaxis,)*i + (slice(None),) + (np.newaxis,)*(n_axes-i-1)
+        gauss.append(g[expand])
+        d_gauss.append((4*x/atom_radius**2 * g)[expand])
+    batch_shape = gauss[0].shape[:-n_axes]
+    if density is None:
+        density = np.empty(batch_shape + (np.prod([x.shape[-1] for x in axes]),))
+    if gradient is None:
+        gradient = np.empty(density.shape + (n_axes,))
+    density[...] = reduce(np.multiply, gauss).reshape(density.shape)
+    for i in range(n_axes):
+        factors = gauss[:i] + [d_gauss[i]] + gauss[i+1:]
+        gradient[...,i] = reduce(np.multiply, factors).reshape(density.shape)
+    return density, gradient
+
+
+def get_atom_density_cutoff(atom_radius, radius_multiple):
+    '''
+    Return the distance from an atom beyond which its density is zero.
+    '''
+    return radius_multiple*atom_radius
+
+
+def get_atom_density2_cutoff(atom_radius, radius_multiple):
+    '''
+    Return the distance from an atom beyond which its Gaussian density
+    is negligible (less than exp(-12.5) of its peak).
+    '''
+    return 2.5*atom_radius
+
+
+# functions for computing atom density, its gradient, or both at a set of
+# points, and optionally on the points of a rectilinear grid given by axes,
+# and the cutoff distance of the density
+density_backend = namedtuple('density_backend', ['density', 'gradient', 'density_and_gradient',
+                                                 'grid_density', 'grid_density_and_gradient', 'cutoff'])
+
+density_backends = dict(
+    piecewise=density_backend(get_atom_density, get_atom_gradient, get_atom_density_and_gradient,
+                              None, None, get_atom_density_cutoff),
+    gaussian=density_backend(get_atom_density2, get_atom_gradient2, get_atom_density_and_gradient2,
+                             get_atom_density2_separable, get_atom_density_and_gradient2_separable,
+                             get_atom_density2_cutoff),
+)
+
+
 def get_bond_length_energy(distance, bond_length, bonds):
     '''
     Compute the interatomic potential energy between an atom and a set of atoms.
@@ -75,17 +213,33 @@ def get_bond_length_gradient(distance, bond_length, bonds):
 
 
 def fit_atoms_by_GMM(points, density, xyz_init, atom_radius, radius_multiple, max_iter, 
-                     noise_model='', noise_params_init={}, gof_crit='nll', verbose=0):
+                     noise_model='', noise_params_init={}, gof_crit='nll', min_density=None,
+                     max_points=None, verbose=0):
     '''
     Fit atom positions to a set of points with the given density values with
     a Gaussian mixture model (and optional noise model). Return the final atom
-    positions and a goodness-of-fit criterion (negative log likelihood, Akaike
-    information criterion, or L2 loss).
+    positions, a goodness-of-fit criterion (negative log likelihood, Akaike
+    information criterion, or L2 loss), and the density mass that was dropped
+    from the fit. If min_density is given, only points with greater density
+    are fit, and if max_points is given, only that many points with the most
+    density are fit.
     '''
     assert gof_crit in {'nll', 'aic', 'L2'}, 'Invalid value for gof_crit argument'
-    n_points = len(points)
+
+    # only fit to points with non-negligible density
+    keep = np.ones(len(points), dtype=bool)
+    if min_density is not None:
+        keep &= density > min_density
+    if max_points is not None and keep.sum() > max_points:
+        keep[np.argpartition(-np.where(keep, density, -np.inf), max_points)[max_points:]] = False
+    dropped_mass = density[~keep].sum()
+    points, density = points[keep], density[keep]
+    if verbose > 1:
+        print('fitting GMM to {} points, dropped mass = {}'.format(len(points), dropped_mass), file=sys.stderr)
+
+    n_points, n_dims = points.shape
     n_atoms = len(xyz_init)
-    xyz = np.array(xyz_init)
+    xyz = np.array(xyz_init).reshape((n_atoms, n_dims))
     atom_radius = np.array(atom_radius)
     cov = (0.5*atom_radius)**2
     n_params = xyz.size
@@ -110,27 +264,28 @@ def fit_atoms_by_GMM(points, density, xyz_init, atom_radius, radius_multiple, ma
     i = 0
     while True:
 
-        L_point = np.zeros((n_points, n_comps)) # P(point_i|comp_j)
-        for j in range(n_atoms):
-            L_point[:,j] = multivariate_normal.pdf(points, mean=xyz[j], cov=cov[j])
+        # log P(point_i|comp_j), using that atom components are isotropic
+        logL_point = np.zeros((n_points, n_comps))
+        dist2 = (points**2).sum(axis=1)[:,np.newaxis] + (xyz**2).sum(axis=1)[np.newaxis,:] \
+              - 2*np.dot(points, xyz.T)
+        logL_point[:,:n_atoms] = -0.5*(n_dims*np.log(2*np.pi*cov) + np.maximum(dist2, 0)/cov)
         if noise_model == 'd':
-            L_point[:,-1] = multivariate_normal.pdf(density, mean=noise_mean, cov=noise_cov)
+            logL_point[:,-1] = -0.5*(np.log(2*np.pi*noise_cov) + (density - noise_mean)**2/noise_cov)
         elif noise_model == 'p':
-            L_point[:,-1] = noise_prob
+            logL_point[:,-1] = np.log(noise_prob)
 
-        P_joint = P_comp * L_point          # P(point_i, comp_j)
-        P_point = np.sum(P_joint, axis=1)   # P(point_i)
-        gamma = (P_joint.T / P_point).T     # P(comp_j|point_i) (E-step)
+        logP_joint = np.log(P_comp) + logL_point        # log P(point_i, comp_j)
+        logP_point = logsumexp(logP_joint, axis=1)      # log P(point_i)
+        gamma = np.exp(logP_joint - logP_point[:,np.newaxis]) # P(comp_j|point_i) (E-step)
 
         # compute expected log likelihood
-        ll_prev, ll = ll, np.sum(density * np.log(P_point))
+        ll_prev, ll = ll, np.sum(density * logP_point)
         if ll - ll_prev < 1e-3 or i == max_iter:
             break
 
         # estimate parameters that maximize expected log likelihood (M-step)
-        for j in range(n_atoms):
-            xyz[j] = np.sum(density * gamma[:,j] * points.T, axis=1) \
-                   / np.sum(density * gamma[:,j])
+        weights = density[:,np.newaxis] * gamma[:,:n_atoms]
+        xyz = np.dot(weights.T, points) / weights.sum(axis=0)[:,np.newaxis]
         if noise_model == 'd':
             noise_mean = np.sum(gamma[:,-1] * density) / np.sum(gamma[:,-1])
             noise_cov = np.sum(gamma[:,-1] * (density - noise_mean)**2) / np.sum(gamma[:,-1])
@@ -157,47 +312,126 @@ def fit_atoms_by_GMM(points, density, xyz_init, atom_radius, radius_multiple, ma
     else:
         gof = -ll
 
-    return xyz, gof
+    return xyz, gof, dropped_mass
+
+
+def conv_grids_spectra(grids, F_h):
+    '''
+    Circularly convolve each of a stack of real-valued grids with the
+    corresponding kernel in a stack of kernel real FFTs of the same grid
+    shape, using one batched real FFT over the spatial axes.
+    '''
+    shape = grids.shape[1:]
+    spatial_axes = tuple(range(1, grids.ndim))
+    F_grids = np.fft.rfftn(grids, axes=spatial_axes)
+    return np.fft.irfftn(F_grids * F_h, s=shape, axes=spatial_axes)
 
 
-def conv_grid(grid, kernel):
-    # convolution theorem: g * grid = F-1(F(g)F(grid))
-    F_h = np.fft.fftn(kernel)
-    F_grid = np.fft.fftn(grid)
-    return np.real(np.fft.ifftn(F_grid * F_h))
+def wiener_deconv_grids(grids, channels, resolution, radius_multiple, noise_ratio=0.0, radius_factor=1.0,
+                        density_backend='piecewise'):
+    '''
+    Apply Wiener deconvolution with each channel's atom density kernel to
+    a stack of channel grids, using one batched real FFT over the spatial
+    axes.
+    '''
+    atomic_radii = tuple(c.atomic_radius*radius_factor for c in channels)
+    F_g = get_wiener_filter_bank(grids.shape[1:], resolution, atomic_radii, radius_multiple, noise_ratio,
+                                 density_backend)
+    return conv_grids_spectra(grids, F_g).astype(grids.dtype)
 
 
-def wiener_deconv_grid(grid, kernel, noise_ratio=0.0):
+@cache_util.lru_cache(maxsize=64)
+def get_wiener_filter_spectrum(shape, resolution, atom_radius, radius_mult, noise_ratio,
+                               density_backend='piecewise'):
     '''
-    Applies a convolution to the input grid that approximates the inverse
-    of the operation that converts a set of atom positions to a grid of
-    atom density.
+    Return the read-only real FFT of the Wiener deconvolution filter for
+    the density kernel of an atom with a certain radius on a grid.
     '''
-    # we want a convolution g such that g * grid = a, where a is the atom positions
-    # we assume that grid = h * a, so g is the inverse of h: g * (h * a) = a
-    # take F() to be the Fourier transform, F-1() the inverse Fourier transform
-    # convolution theorem: g * grid = F-1(F(g)F(grid))
+    points = get_grid_points(shape, 0, resolution)
+    backend = density_backends[density_backend]
+    if backend.grid_density:
+        axes = [p + resolution*np.arange(n) for p, n in zip(points[0], shape)]
+        kernel = backend.grid_density(np.full(3, resolution/2), atom_radius, axes).reshape(shape)
+    else:
+        kernel = backend.density(resolution/2, atom_radius, points, radius_mult).reshape(shape)
+    kernel = np.roll(kernel, shift=[d//2 for d in shape], axis=range(len(shape)))
+
     # Wiener deconvolution: F(g) = 1/F(h) |F(h)|^2 / (|F(h)|^2 + noise_ratio)
-    F_h = np.fft.fftn(kernel)
-    F_grid = np.fft.fftn(grid)
+    F_h = np.fft.rfftn(kernel)
     conj_F_h = np.conj(F_h)
-    F_g = conj_F_h / (F_h*conj_F_h + noise_ratio)
-    return np.real(np.fft.ifftn(F_grid * F_g))
+    return cache_util.read_only(conj_F_h / (F_h*conj_F_h + noise_ratio))
 
 
-def wiener_deconv_grids(grids, channels, resolution, radius_multiple, noise_ratio=0.0, radius_factor=1.0):
+@cache_util.lru_cache(maxsize=16)
+def get_wiener_filter_bank(shape, resolution, atomic_radii, radius_mult, noise_ratio,
+                           density_backend='piecewise'):
+    '''
+    Return a read-only stack of the real FFTs of Wiener deconvolution
+    filters for each of a tuple of atomic radii.
+    '''
+    return cache_util.read_only(np.stack([
+        get_wiener_filter_spectrum(shape, resolution, r, radius_mult, noise_ratio, density_backend)
+            for r in atomic_radii
+    ]))
 
-    deconv_grids = np.zeros_like(grids)
-    points = get_grid_points(grids.shape[1:], 0, resolution)
 
-    for i, grid in enumerate(grids):
+def get_grid_window(atom_pos, cutoff, shape, origin, resolution):
+    '''
+    Return the index ranges along each axis of a grid with a certain
+    shape, origin, and resolution that bound a sphere with a cutoff
+    radius around an atom position.
+    '''
+    shape = np.array(shape)
+    lo = np.ceil((atom_pos - cutoff - origin)/resolution).astype(int)
+    hi = np.floor((atom_pos + cutoff - origin)/resolution).astype(int) + 1
+    lo = np.clip(lo, 0, shape)
+    hi = np.clip(hi, lo, shape)
+    return [np.arange(l, h) for l, h in zip(lo, hi)]
 
-        r = channels[i].atomic_radius*radius_factor
-        kernel = get_atom_density(resolution/2, r, points, radius_multiple).reshape(grid.shape)
-        kernel = np.roll(kernel, shift=[d//2 for d in grid.shape], axis=range(grid.ndim))
-        deconv_grids[i,...] = wiener_deconv_grid(grid, kernel, noise_ratio)
 
-    return np.stack(deconv_grids, axis=0)
+def get_grid_windows(xyz, cutoff, shape, origin, resolution):
+    '''
+    Return the flat indices of the points of a grid with a certain shape,
+    origin, and resolution that lie in same-size windows bounding spheres
+    with a cutoff radius around each of a set of atom positions, a mask of
+    which window points are inside the grid, and the indices along each axis
+    of the first point of each window. Points outside the grid have index 0.
+    '''
+    shape = np.array(shape)
+    n_axes = len(shape)
+    width = int(2*cutoff/resolution) + 1
+    lo = np.ceil((xyz - cutoff - origin)/resolution).astype(int)
+    axis_idx = lo[:,:,np.newaxis] + np.arange(width)
+    axis_in_grid = (axis_idx >= 0) & (axis_idx < shape[:,np.newaxis])
+    strides = np.append(np.cumprod(shape[:0:-1])[::-1], 1)
+    indices = 0
+    in_grid = True
+    for i in range(n_axes): # outer sum and product over the axes
+        expand = (slice(None),) + (np.newaxis,)*i + (slice(None),) + (np.newaxis,)*(n_axes-i-1)
+        indices = indices + (strides[i]*axis_idx[:,i])[expand]
+        in_grid = in_grid & axis_in_grid[:,i][expand]
+    window_shape = (len(xyz), width**n_axes)
+    indices = np.where(in_grid, indices, 0).reshape(window_shape)
+    return indices, in_grid.reshape(window_shape), lo
+
+
+def get_window_indices(ranges, shape):
+    '''
+    Return the flat indices of the points of a grid with a certain
+    shape that are in the window given by index ranges along each axis.
+    '''
+    indices = np.meshgrid(*ranges, indexing='ij')
+    return np.ravel_multi_index(indices, shape).ravel()
+
+
+@cache_util.lru_cache(maxsize=16)
+def get_grid_offsets(shape, resolution):
+    '''
+    Return a read-only array of the offsets of grid points with
+    a certain shape and resolution from the grid origin.
+    '''
+    indices = np.indices(shape).reshape(len(shape), -1).T
+    return cache_util.read_only(np.array(resolution)*indices)
 
 
 def get_grid_points(shape, center, resolution):
@@ -208,8 +442,7 @@ def get_grid_points(shape, center, resolution):
     center = np.array(center)
     resolution = np.array(resolution)
     origin = center - resolution*(shape - 1)/2.0
-    indices = np.array(list(np.ndindex(*shape)))
-    return origin + resolution*indices
+    return origin + get_grid_offsets(tuple(shape), tuple(np.ravel(resolution)))
 
 
 def grid_to_points_and_values(grid, center, resolution):
@@ -221,97 +454,474 @@ def grid_to_points_and_values(grid, center, resolution):
     return points, grid.flatten()
 
 
-def get_atom_density_kernel(shape, resolution, atom_radius, radius_mult):
+@cache_util.lru_cache(maxsize=64)
+def get_atom_density_kernel(shape, resolution, atom_radius, radius_mult, density_backend='piecewise'):
+    '''
+    Return a read-only grid of the density of an atom at the grid center.
+    '''
     center = np.zeros(len(shape))
     points = get_grid_points(shape, center, resolution)
-    density = get_atom_density(center, atom_radius, points, radius_mult)
-    return density.reshape(shape)
+    backend = density_backends[density_backend]
+    if backend.grid_density:
+        axes = [p + resolution*np.arange(n) for p, n in zip(points[0], shape)]
+        density = backend.grid_density(center, atom_radius, axes)
+    else:
+        density = backend.density(center, atom_radius, points, radius_mult)
+    return cache_util.read_only(density.reshape(shape))
+
+
+@cache_util.lru_cache(maxsize=64)
+def get_atom_density_kernel_spectrum(shape, resolution, atom_radius, radius_mult, density_backend='piecewise'):
+    '''
+    Return the read-only real FFT of an atom density kernel, shifted so that
+    convolving a grid with it gives the correlation with an atom at each point.
+    '''
+    kernel = get_atom_density_kernel(shape, resolution, atom_radius, radius_mult, density_backend)
+    kernel = np.roll(kernel, np.array(shape)//2, range(len(shape)))
+    return cache_util.read_only(np.fft.rfftn(kernel))
+
+
+@cache_util.lru_cache(maxsize=16)
+def get_atom_density_kernel_spectra(shape, resolution, atomic_radii, radius_mult, density_backend='piecewise'):
+    '''
+    Return a read-only stack of the real FFTs of atom density
+    kernels for each of a tuple of atomic radii.
+    '''
+    return cache_util.read_only(np.stack([
+        get_atom_density_kernel_spectrum(shape, resolution, r, radius_mult, density_backend)
+            for r in atomic_radii
+    ]))
+
+
+@cache_util.lru_cache(maxsize=64)
+def get_atom_conv_response(shape, resolution, atom_radius, radius_mult, density_backend='piecewise'):
+    '''
+    Return a read-only box of the convolution of an atom density kernel with the
+    density of an atom at a grid point, and the index of that grid point
+    within the box.
+    '''
+    F_h = get_atom_density_kernel_spectrum(shape, resolution, atom_radius, radius_mult, density_backend)
+    points = get_grid_points(shape, np.zeros(len(shape)), resolution)
+    idx = np.array(shape)//2
+    atom_pos = points[np.ravel_multi_index(idx, shape)]
+    density = density_backends[density_backend].density(atom_pos, atom_radius, points, radius_mult)
+    conv = conv_grids_spectra(density.reshape((1,) + shape), F_h[np.newaxis,...])[0]
+    width = int(np.ceil(2*radius_mult*atom_radius/resolution)) + 1
+    lo = np.maximum(idx - width, 0)
+    hi = np.minimum(idx + width + 1, shape)
+    box = conv[tuple(slice(l, h) for l, h in zip(lo, hi))]
+    return cache_util.read_only(box.copy()), idx - lo
+
+
+def add_grid_box(grid, box, box_idx, idx, weight=1.0):
+    '''
+    Add a box of values times a weight to a grid in place, aligning the
+    index box_idx of the box with the index idx of the grid and clipping
+    the box to the grid bounds.
+    '''
+    lo = np.array(idx) - box_idx
+    hi = lo + box.shape
+    grid_lo = np.maximum(lo, 0)
+    grid_hi = np.minimum(hi, grid.shape)
+    if np.any(grid_hi <= grid_lo):
+        return
+    grid_slices = tuple(slice(l, h) for l, h in zip(grid_lo, grid_hi))
+    box_slices = tuple(slice(l, h) for l, h in zip(grid_lo - lo, grid_hi - lo))
+    grid[grid_slices] += weight*box[box_slices]
+
+
+def get_conv_peaks(convs, thresholds, points, radii):
+    '''
+    Return the flat grid indices and channel indices of the local maxima of
+    a stack of channel correlation grids that are above each channel's
+    threshold, in decreasing order of height above the threshold. Peaks
+    within the channel's radius of a higher peak in any channel are
+    suppressed.
+    '''
+    ax = (slice(None),) + (np.newaxis,)*(convs.ndim-1)
+    footprint = np.ones((1,) + (3,)*(convs.ndim-1), dtype=bool)
+    is_peak = (convs == maximum_filter(convs, footprint=footprint)) & (convs > thresholds[ax])
+    c_peak, idx_peak = np.nonzero(is_peak.reshape(len(convs), -1))
+    height = convs.reshape(len(convs), -1)[c_peak, idx_peak] - thresholds[c_peak]
+    order = np.argsort(-height)
+    idx_new, c_new = [], []
+    for idx, c in zip(idx_peak[order], c_peak[order]):
+        if idx_new:
+            dist = np.linalg.norm(points[idx_new] - points[idx], axis=1)
+            if np.any(dist < radii[c]):
+                continue
+        idx_new.append(idx)
+        c_new.append(c)
+    return idx_new, c_new
+
+
+def minimize_by_GD(f, x, max_iter, lr, mo, tol=1e-2, deadline=np.inf, verbose=0):
+    '''
+    Minimize a function f of an array x that returns a loss and its gradient
+    by gradient descent with momentum, starting from x, until the relative
+    change in loss is less than tol, after max_iter steps, or after the time
+    deadline. Return the final x and loss, and a dict of stats.
+    '''
+    x = np.array(x)
+    loss = np.inf
+    gradient = np.zeros_like(x)
+    i = 0
+    while True:
+        loss_prev, gradient_prev = loss, gradient
+        loss, gradient = f(x)
+
+        delta_loss = loss - loss_prev
+        if verbose > 2:
+            print('iter = {}\tloss = {} ({})'.format(i, loss, delta_loss), file=sys.stderr)
+
+        converged = abs(delta_loss)/(abs(loss_prev) + 1e-8) < tol
+        if converged or i == max_iter or time.time() > deadline:
+            break
+
+        x -= lr*(mo*gradient_prev + (1-mo)*gradient)
+        i += 1
+
+    return x, loss, dict(n_iters=i, converged=converged)
+
+
+def minimize_by_LBFGS(f, x, max_iter, lr=None, mo=None, tol=1e-2, deadline=np.inf, verbose=0):
+    '''
+    Minimize a function f of an array x that returns a loss and its gradient
+    by the L-BFGS quasi-Newton method with line search, starting from x, until
+    the relative change in loss is less than tol, after max_iter iterations,
+    or after the first iteration past the time deadline. Return the final x
+    and loss, and a dict of stats. The learning rate and momentum are not used.
+    '''
+    if max_iter == 0:
+        loss, gradient = f(x)
+        return x, loss, dict(n_iters=0, converged=False)
+
+    # stop from the iteration callback when past the deadline
+    iters = []
+    def callback(x):
+        iters.append(np.array(x))
+        if time.time() > deadline:
+            raise StopIteration
+
+    options = dict(ftol=tol)
+    if np.isfinite(max_iter):
+        options['maxiter'] = int(max_iter)
+    try:
+        result = minimize(f, x, jac=True, method='L-BFGS-B', options=options, callback=callback)
+    except StopIteration:
+        loss, gradient = f(iters[-1])
+        return iters[-1], loss, dict(n_iters=len(iters), converged=False)
+    if verbose > 2:
+        print('L-BFGS {} iters: {}'.format(result.nit, result.message), file=sys.stderr)
+
+    return result.x, result.fun, dict(n_iters=result.nit, converged=result.success)
+
+
+optimizers = dict(
+    GD=minimize_by_GD,
+    LBFGS=minimize_by_LBFGS,
+)
 
 
 def fit_atoms_by_GD(points, density, xyz, c, bonds, atomic_radii, max_iter, 
                     lr, mo, lambda_E=0.0, radius_multiple=1.5, verbose=0,
-                    density_pred=None, density_diff=None):
+                    density_pred=None, density_diff=None, grid_shape=None, resolution=None,
+                    windowed=True, density_backend='piecewise', batched=True, max_batch_points=2**20,
+                    incremental=False, move_tol=None, max_move_frac=0.25, rebuild_every=10,
+                    optimizer='GD', tol=1e-2, deadline=np.inf):
     '''
     Fit atom positions, provided by arrays xyz initial positions, c channel indices, 
     and optional bonds matrix, to arrays of points with the given channel density values.
-    Minimize the L2 loss (and optionally interatomic energy) between the provided density
-    and fitted density by gradient descent with momentum. Return the final atom positions
-    and loss.
+    Minimize the L2 loss (and optionally interatomic energy of bonded atoms) between the
+    provided density and fitted density using the given optimizer (see optimizers), by
+    default gradient descent with momentum, until it converges or after max_iter steps
+    or the time deadline. Return the final atom positions, predicted density,
+    density difference, loss, and a dict of optimizer stats. If the points are a
+    grid from get_grid_points and its grid_shape and resolution are provided, each
+    atom's density and gradient are only evaluated at the grid points within its
+    cutoff window if windowed, and are evaluated on the grid axes if the
+    density_backend is separable. If windowed and batched, the windows
+    of all atoms are evaluated at once, at most max_batch_points atom-point pairs at a
+    time, and the loss and gradient are computed only at the distinct points in their
+    windows, filling in the full predicted density once at the end. If
+    also incremental, only atoms that moved more than move_tol (default 1% of the
+    resolution) since they were last evaluated are re-evaluated. All atoms are
+    re-evaluated every rebuild_every iterations, when more than max_move_frac of them
+    moved, or when none did, so the optimizer never sees an unchanged stale loss.
     '''
     n_atoms = len(xyz)
+    backend = density_backends[density_backend]
+
+    on_grid = grid_shape is not None
+    separable = on_grid and backend.grid_density is not None
+    windowed &= on_grid
+    batched &= windowed and n_atoms > 0
+    incremental &= batched
+    if incremental and move_tol is None:
+        move_tol = resolution/100.0
+    if on_grid:
+        origin = points[0]
+        ranges = [[np.arange(n) for n in grid_shape] for j in range(n_atoms)]
+    idx = [slice(None) for j in range(n_atoms)]
+    n_idx = np.full(n_atoms, len(points), dtype=int)
 
     xyz = np.array(xyz)
-    d_loss_d_xyz = np.zeros_like(xyz)
-    d_loss_d_xyz_prev = np.zeros_like(xyz)
-    
+
     if density_pred is None:
         density_pred = np.zeros_like(density)
     if density_diff is None:
         density_diff = np.zeros_like(density)
 
+    # scratch buffers for each atom's density and gradient, reused across iterations
+    if windowed and n_atoms > 0:
+        max_cutoff = backend.cutoff(np.max(atomic_radii), radius_multiple)
+        max_width = int(2*max_cutoff/resolution) + 1
+        max_n_idx = max_width**len(grid_shape)
+    else:
+        max_n_idx = len(points)
+    atom_density = np.zeros((n_atoms, max_n_idx))
+    atom_gradient = np.zeros((n_atoms, max_n_idx, 3))
+    if batched:
+        n_channels = density.shape[1]
+        batch_size = max(max_batch_points//max_n_idx, 1)
+        batch_density = np.zeros((batch_size, max_n_idx))
+        batch_gradient = np.zeros((batch_size, max_n_idx, 3))
+        window_idx = np.zeros((n_atoms, max_n_idx), dtype=int)
+        xyz_eval = np.zeros_like(xyz)
+
+        # the predicted density is only accumulated at the points in atom windows,
+        # so the loss at other points is the energy of the density outside them
+        density_flat = density.ravel()
+        density_energy = np.dot(density_flat.astype(float), density_flat)
+        window_slot = np.zeros(density.size, dtype=int)
+        window_entries = np.arange(window_idx.size)
+
     ax = np.newaxis
-    if lambda_E:
-        xyz_diff = np.zeros((n_atoms, n_atoms, 3))
-        xyz_dist = np.zeros((n_atoms, n_atoms))
-        bond_length = atomic_radii[:,ax] + atomic_radii[ax,:]
+    if lambda_E: # interatomic energy is only nonzero between bonded atoms
+        bond_i, bond_j = np.nonzero(np.triu(bonds, 1))
+        bond_weight = bonds[bond_i,bond_j]
+        bond_length = atomic_radii[bond_i] + atomic_radii[bond_j]
+
+    # loss function of atom positions that also returns its gradient, and
+    # leaves the predicted density of the last positions it was evaluated at
+    state = dict(n_evals=0, density_loss=0.0, last_rebuild=0, force_rebuild=False)
+    def get_loss_and_gradient(x):
+        xyz[...] = x.reshape(xyz.shape)
+        i = state['n_evals']
+        density_loss = state['density_loss']
+
+        # L2 loss between predicted and true density, and density gradients
+        if batched:
+
+            force_rebuild = state['force_rebuild']
+            while True:
+                # evaluate atoms that moved since their last evaluation, or all atoms on a rebuild
+                rebuild = force_rebuild or not incremental or i == 0 or \
+                    i - state['last_rebuild'] >= rebuild_every
+                if not rebuild:
+                    update = np.flatnonzero(np.linalg.norm(xyz - xyz_eval, axis=1) > move_tol)
+                    rebuild = len(update) == 0 or len(update) > max_move_frac*n_atoms
+                if rebuild:
+                    update = np.arange(n_atoms)
+                    state['last_rebuild'] = i
+
+                if len(update) > 0:
+                    update_idx, in_grid, update_lo = get_grid_windows(xyz[update], max_cutoff, grid_shape,
+                                                                      origin, resolution)
+                    for k in range(0, len(update), batch_size):
+                        batch = update[k:k+batch_size]
+                        n = len(batch)
+                        if rebuild: # evaluate in place
+                            density_k, gradient_k = atom_density[k:k+n], atom_gradient[k:k+n]
+                        else:
+                            density_k, gradient_k = batch_density[:n], batch_gradient[:n]
+                        if separable: # window axes start at the first point of each window
+                            axes = [origin[l] + resolution*(update_lo[k:k+n,l,ax] + np.arange(max_width)) \
+                                        for l in range(len(grid_shape))]
+                            backend.grid_density_and_gradient(xyz[batch], atomic_radii[batch], axes,
+                                                              density_k, gradient_k)
+                        else:
+                            backend.density_and_gradient(xyz[batch,ax,:], atomic_radii[batch,ax],
+                                                         points[update_idx[k:k+n]], radius_multiple,
+                                                         density_k, gradient_k)
+                        if not in_grid[k:k+n].all():
+                            density_k *= in_grid[k:k+n]
+                            gradient_k *= in_grid[k:k+n,:,ax]
+                        if not rebuild:
+                            atom_density[batch] = density_k
+                            atom_gradient[batch] = gradient_k
+
+                    # flat indices into density arrays of shape (n_points, n_channels)
+                    window_idx[update] = update_idx*n_channels + c[update,ax]
+                    xyz_eval[update] = xyz[update]
+
+                # accumulate window densities at the distinct window points, found by letting
+                # every window entry write its index to its point and reading back the winner
+                flat_idx = window_idx.ravel()
+                window_slot[flat_idx] = window_entries
+                entry_slot = window_slot[flat_idx]
+                slot_pred = np.bincount(entry_slot, weights=atom_density.ravel(), minlength=len(flat_idx))
+                is_slot = entry_slot == window_entries
+                slot_idx = flat_idx[is_slot]
+                slot_density = density_flat[slot_idx].astype(float)
+                slot_diff = slot_density - slot_pred[is_slot]
+                density_loss = max(density_energy - np.dot(slot_density, slot_density), 0.0) \
+                    + np.dot(slot_diff, slot_diff)
+                window_diff = (density_flat[flat_idx] - slot_pred[entry_slot]).reshape(window_idx.shape)
+                state['slot_idx'], state['slot_pred'] = slot_idx, slot_pred[is_slot]
+
+                # a partial update that looks converged may only be missing the motion of atoms
+                # that were not re-evaluated, so the optimizer only sees it after a full rebuild
+                prev_loss = state['density_loss']
+                if rebuild or abs(density_loss - prev_loss) >= tol*(abs(prev_loss) + 1e-8):
+                    break
+                force_rebuild = True
 
-    # minimize loss by gradient descent
-    loss = np.inf
-    i = 0
-    while True:
-        loss_prev = loss
+        else:
+            density_pred[...] = 0.0
+            for j in range(n_atoms):
+                if windowed:
+                    cutoff = backend.cutoff(atomic_radii[j], radius_multiple)
+                    ranges[j] = get_grid_window(xyz[j], cutoff, grid_shape, origin, resolution)
+                    idx[j] = get_window_indices(ranges[j], grid_shape)
+                    n_idx[j] = len(idx[j])
+                density_j = atom_density[j,:n_idx[j]]
+                gradient_j = atom_gradient[j,:n_idx[j]]
+                if separable:
+                    axes = [o + resolution*r for o, r in zip(origin, ranges[j])]
+                    backend.grid_density_and_gradient(xyz[j], atomic_radii[j], axes, density_j, gradient_j)
+                else:
+                    backend.density_and_gradient(xyz[j], atomic_radii[j], points[idx[j]], radius_multiple,
+                                                 density_j, gradient_j)
+                density_pred[idx[j],c[j]] += density_j
 
-        # L2 loss between predicted and true density
-        density_pred[...] = 0.0
-        for j in range(n_atoms):
-            density_pred[:,c[j]] += get_atom_density(xyz[j], atomic_radii[j], points, radius_multiple)
+            density_diff[...] = density - density_pred
+            density_loss = (density_diff**2).sum()
 
-        density_diff[...] = density - density_pred
-        loss = (density_diff**2).sum()
+        state['n_evals'] += 1
+        state['density_loss'] = density_loss
+        loss = density_loss
 
         # interatomic energy of predicted atom positions
         if lambda_E:
-            xyz_diff[...] = xyz[:,ax,:] - xyz[ax,:,:]
-            xyz_dist[...] = np.linalg.norm(xyz_diff, axis=2)
-            for j in range(n_atoms):
-                loss += lambda_E * get_bond_length_energy(xyz_dist[j,j+1:], bond_length[j,j+1:], bonds[j,j+1:]).sum()
+            bond_diff = xyz[bond_i] - xyz[bond_j]
+            bond_dist = np.linalg.norm(bond_diff, axis=1)
+            loss += lambda_E * get_bond_length_energy(bond_dist, bond_length, bond_weight).sum()
 
-        delta_loss = loss - loss_prev
-        if verbose > 2:
-            print('n_atoms = {}\titer = {}\tloss = {} ({})'.format(n_atoms, i, loss, delta_loss), file=sys.stderr)
+        # compute derivatives of loss
+        if batched:
+            d_loss_d_xyz = -2*np.einsum('ij,ijk->ik', window_diff, atom_gradient)
+        else:
+            d_loss_d_xyz = np.zeros_like(xyz)
+            for j in range(n_atoms):
+                d_loss_d_xyz[j] += -2*np.dot(density_diff[idx[j],c[j]], atom_gradient[j,:n_idx[j]])
 
-        if n_atoms == 0 or i == max_iter or abs(delta_loss)/(abs(loss_prev) + 1e-8) < 1e-2:
-            break
+        if lambda_E:
+            d_E_d_dist = get_bond_length_gradient(bond_dist, bond_length, bond_weight)
+            d_E_d_xyz = lambda_E * bond_diff * (d_E_d_dist / bond_dist)[:,ax]
+            np.add.at(d_loss_d_xyz, bond_i, d_E_d_xyz)
+            np.add.at(d_loss_d_xyz, bond_j, -d_E_d_xyz)
+
+        return loss, d_loss_d_xyz.ravel()
+
+    # minimize loss with respect to atom positions
+    if n_atoms == 0:
+        max_iter = 0
+    x, loss, stats = optimizers[optimizer](get_loss_and_gradient, xyz.flatten(), max_iter, lr=lr, mo=mo,
+                                           tol=tol, deadline=deadline, verbose=verbose)
+    stale = incremental and state['last_rebuild'] < state['n_evals'] - 1
+    if stale or not np.array_equal(xyz.ravel(), x): # make predicted density match the final positions
+        state['force_rebuild'] = True
+        loss = get_loss_and_gradient(x)[0]
+    stats['n_evals'] = state['n_evals']
+
+    if batched: # fill in the predicted density and difference at every point
+        density_pred[...] = 0.0
+        density_pred[np.unravel_index(state['slot_idx'], density.shape)] = state['slot_pred']
+        density_diff[...] = density - density_pred
 
-        # compute derivatives and descend loss gradient
-        d_loss_d_xyz_prev[...] = d_loss_d_xyz
-        d_loss_d_xyz[...] = 0.0
+    if verbose > 2:
+        print('n_atoms = {}\titers = {}\tevals = {}\tloss = {}'.format(n_atoms, stats['n_iters'],
+              stats['n_evals'], loss), file=sys.stderr)
 
-        for j in range(n_atoms):
-            d_density_d_xyz = get_atom_gradient(xyz[j], atomic_radii[j], points, radius_multiple)
-            d_loss_d_xyz[j] += (-2*density_diff[:,c[j],ax] * d_density_d_xyz).sum(axis=0)
+    return xyz, density_pred, density_diff, loss, stats
 
-        if lambda_E:
-            for j in range(n_atoms-1):
-                d_E_d_dist = get_bond_length_gradient(xyz_dist[j,j+1], bond_length[j,j+1], bonds[j,j+1:])
-                d_E_d_xyz = xyz_diff[j,j+1:] * (d_E_d_dist / xyz_dist[j,j+1:])[:,ax]
-                d_xyz[j] += lambda_E * d_E_d_xyz.sum(axis=0)
-                d_xyz[j+1:,:] -= lambda_E * d_E_d_xyz
 
-        xyz[...] -= lr*(mo*d_loss_d_xyz_prev + (1-mo)*d_loss_d_xyz)
-        i += 1
+def downsample_grid(grid, center, resolution, factor):
+    '''
+    Downsample the spatial axes of a multi-channel grid with a certain
+    center and resolution by an integer factor, averaging each block of
+    points after zero-padding the grid to a multiple of the factor. Return
+    the downsampled grid and its center.
+    '''
+    shape = np.array(grid.shape[1:])
+    coarse_shape = -(-shape//factor)
+    padding = [(0, 0)] + [(0, n) for n in factor*coarse_shape - shape]
+    grid = np.pad(grid, padding, mode='constant')
+    blocks = grid.reshape((grid.shape[0],) + sum(((n, factor) for n in coarse_shape), ()))
+    coarse_grid = blocks.mean(axis=tuple(range(2, blocks.ndim, 2)))
 
-    return xyz, density_pred, density_diff, loss
+    # block centers are offset from the original grid points
+    origin = np.array(center) - resolution*(shape - 1)/2.0
+    coarse_origin = origin + resolution*(factor - 1)/2.0
+    coarse_center = coarse_origin + factor*resolution*(coarse_shape - 1)/2.0
+    return coarse_grid, coarse_center
 
 
 def fit_atoms_to_grid(grid, channels, center, resolution, max_iter, lr, mo, lambda_E=0.0,
                       radius_multiple=1.5, bonded=False, max_init_bond_E=0.5, fit_channels=None,
+                      windowed=True, density_backend='piecewise', batched=True, max_batch_points=2**20,
+                      incremental=False, move_tol=None, rebuild_every=10, incremental_conv=False,
+                      conv_move_tol=None, multi_atom=False, optimizer='GD', coarsen=1,
+                      time_budget=np.inf, iter_budget=np.inf, deconv_fit=False, noise_ratio=1.0,
                       verbose=0):
     '''
     Fit atoms to grid by iteratively placing atoms and then optimizing their
     positions by gradient descent on L2 loss between the provided grid density
-    and the density associated with the fitted atoms.
+    and the density associated with the fitted atoms. If windowed, atom density
+    is only evaluated within the cutoff distance of each atom, and if also batched,
+    for all atoms at once in batches of at most max_batch_points atom-point pairs.
+    If incremental, gradient descent only re-evaluates atoms that moved more than
+    move_tol (default 1% of the resolution), with a full rebuild every rebuild_every
+    iterations or when few or many atoms moved. The density_backend
+    selects the function used for atom density (see density_backends).
+
+    If incremental_conv, the correlation of the residual density with each kernel
+    used to place new atoms is updated by subtracting the response of each newly
+    placed atom, and only recomputed by FFT when gradient descent moves an atom more
+    than conv_move_tol (default half the resolution) or when no atom can be added.
+
+    If multi_atom, every local maximum of the correlations that decreases the loss
+    is placed as a new atom in each outer iteration, suppressing maxima within an
+    atomic radius of a higher one, instead of only the best atom in each channel.
+
+    Channels whose residual density is too small for any atom to decrease the loss
+    are skipped, and are never correlated again if they have no fitted atoms.
+
+    If bonded, atoms are instead added one at a time by get_next_atom within
+    bonding distance of the fitted atoms, until adding an atom no longer
+    decreases the loss.
+
+    If coarsen is greater than 1, atoms are first fit to the grid downsampled by
+    that factor, and then used as the initial atoms on the full grid, so that most
+    atoms are placed and optimized on a smaller grid.
+
+    If deconv_fit, the initial atoms are instead placed at the peaks of the grid
+    after Wiener deconvolution with the given noise_ratio, suppressing peaks within
+    an atomic radius of a higher one and where an atom would not decrease the loss.
+
+    Atom positions are optimized by the given optimizer (see optimizers). Return
+    the fitted atoms and bonds, grid density and loss, the time taken, and a dict
+    of the total optimizer iterations and loss evaluations over all fits and
+    whether the final fit converged.
+
+    If fitting takes more than time_budget seconds or iter_budget total optimizer
+    iterations, it stops and returns the lowest loss atoms fit so far, and the
+    truncated flag in the returned dict is set.
     '''
+    if bonded and fit_channels is not None:
+        raise NotImplementedError('bonded fitting with fit_channels')
+
     t_start = time.time()
     n_channels, grid_shape = grid.shape[0], grid.shape[1:]
     atomic_radii = np.array([c.atomic_radius for c in channels])
@@ -323,47 +933,155 @@ def fit_atoms_to_grid(grid, channels, center, resolution, max_iter, lr, mo, lamb
     density_pred = np.zeros_like(density)
     density_diff = np.zeros_like(density)
 
-    # init atom density kernels
-    kernels = [get_atom_density(center, r, points, radius_multiple).reshape(grid_shape) \
+    # init atom density kernels and their spectra
+    kernels = [get_atom_density_kernel(grid_shape, resolution, r, radius_multiple, density_backend) \
                for r in atomic_radii]
+    kernel_energy = np.array([(k**2).sum() for k in kernels])
+    kernel_spectra = get_atom_density_kernel_spectra(grid_shape, resolution, tuple(atomic_radii),
+                                                     radius_multiple, density_backend)
+    incremental_conv &= fit_channels is None and not bonded
+    if incremental_conv:
+        conv_responses = [get_atom_conv_response(grid_shape, resolution, r, radius_multiple, density_backend) \
+                          for r in atomic_radii]
+        if conv_move_tol is None:
+            conv_move_tol = resolution/2
+    convs = np.zeros(grid.shape)
+    conv_valid = np.zeros(n_channels, dtype=bool)
+    xyz_conv = np.ndarray((0, 3))
+    active = np.ones(n_channels, dtype=bool)
+    if bonded:
+        points_tree = cKDTree(points)
+        prev_fit = None
 
     # iteratively add atoms, fit, and assess goodness-of-fit
     xyz = np.ndarray((0, 3))
     c = np.ndarray(0, dtype=int)
     bonds = np.ndarray((0, 0))
     loss = np.inf
+    stats = dict(n_iters=0, n_evals=0, converged=False, truncated=False)
+    deadline = t_start + time_budget
+    if np.isfinite(time_budget) or np.isfinite(iter_budget):
+        best_fit = None
+
+    if coarsen > 1: # init atoms by fitting to a downsampled grid
+        coarse_grid, coarse_center = downsample_grid(grid, center, resolution, coarsen)
+        n_coarse = coarsen**len(grid_shape) # scale of loss on the full grid relative to the coarse grid
+        xyz, c, bonds, _, _, _, coarse_stats = fit_atoms_to_grid(
+            coarse_grid, channels, coarse_center, coarsen*resolution, max_iter, n_coarse*lr, mo,
+            lambda_E=lambda_E/n_coarse, radius_multiple=radius_multiple, bonded=bonded,
+            max_init_bond_E=max_init_bond_E, fit_channels=fit_channels, windowed=windowed,
+            density_backend=density_backend, batched=batched, max_batch_points=max_batch_points,
+            incremental=incremental, move_tol=move_tol, rebuild_every=rebuild_every,
+            incremental_conv=incremental_conv, multi_atom=multi_atom, optimizer=optimizer,
+            time_budget=time_budget, iter_budget=iter_budget, deconv_fit=deconv_fit,
+            noise_ratio=noise_ratio, verbose=verbose
+        )
+        stats['n_iters'] += coarse_stats['n_iters']
+        stats['n_evals'] += coarse_stats['n_evals']
+        stats['truncated'] = coarse_stats['truncated']
+        xyz_conv = np.array(xyz) # correlations are not valid for the initial atoms
+
+    elif deconv_fit and fit_channels is None and not bonded: # init atoms at deconvolved peaks
+        deconv = wiener_deconv_grids(grid, channels, resolution, radius_multiple, noise_ratio,
+                                     density_backend=density_backend)
+        ax = (slice(None),) + (np.newaxis,)*len(grid_shape)
+        deconv[conv_grids_spectra(grid, kernel_spectra) <= kernel_energy[ax]/2] = 0.0
+        idx_init, c_init = get_conv_peaks(deconv, np.zeros(n_channels), points, atomic_radii)
+        xyz = points[idx_init]
+        c = np.array(c_init, dtype=int)
+        xyz_conv = np.array(xyz) # correlations are not valid for the initial atoms
 
     while True:
 
-        # optimize atom positions by gradient descent
-        xyz, density_pred, density_diff, loss = \
-            fit_atoms_by_GD(points, density, xyz, c, bonds, atomic_radii[c], max_iter, lr=lr, mo=mo,
+        # optimize atom positions within the remaining iteration budget
+        fit_iter = min(max_iter, max(iter_budget - stats['n_iters'], 0))
+        xyz, density_pred, density_diff, loss, fit_stats = \
+            fit_atoms_by_GD(points, density, xyz, c, bonds, atomic_radii[c], fit_iter, lr=lr, mo=mo,
                             lambda_E=lambda_E, radius_multiple=radius_multiple, verbose=verbose,
-                            density_pred=density_pred, density_diff=density_diff)
+                            density_pred=density_pred, density_diff=density_diff,
+                            grid_shape=grid_shape, resolution=resolution, windowed=windowed,
+                            density_backend=density_backend, batched=batched,
+                            max_batch_points=max_batch_points, incremental=incremental,
+                            move_tol=move_tol, rebuild_every=rebuild_every, optimizer=optimizer,
+                            deadline=deadline)
+        stats['n_iters'] += fit_stats['n_iters']
+        stats['n_evals'] += fit_stats['n_evals']
+        stats['converged'] = fit_stats['converged']
 
         if verbose > 1:
             print('n_atoms = {}\t\t\tloss = {}'.format(len(xyz), loss))
 
+        if np.isfinite(time_budget) or np.isfinite(iter_budget): # stop if out of budget
+            if best_fit is None or loss < best_fit[-1]:
+                best_fit = xyz, c, bonds, density_pred.copy(), loss
+            if time.time() > deadline or stats['n_iters'] >= iter_budget:
+                xyz, c, bonds, density_pred, loss = best_fit
+                stats['truncated'] = True
+                break
+
+        if bonded: # bonded atoms are placed without checking the loss, so undo if it increased
+            if prev_fit is not None and loss >= prev_fit[-1]:
+                xyz, c, bonds, density_pred, loss = prev_fit
+                break
+            prev_fit = xyz, c, bonds, density_pred.copy(), loss
+
         # init next atom position on remaining density
         xyz_new = []
         c_new = []
         if fit_channels is not None:
             try:
                 i = fit_channels[len(c)]
-                conv = conv_grid(density_diff[:,i].reshape(grid_shape), kernels[i])
-                conv = np.roll(conv, np.array(grid_shape)//2, range(len(grid_shape)))
+                conv = conv_grids_spectra(density_diff[:,i].reshape((1,) + grid_shape),
+                                          kernel_spectra[i:i+1])[0]
                 xyz_new.append(points[conv.argmax()])
                 c_new.append(i)
             except IndexError:
                 pass
+        elif bonded:
+            # place the max residual density point in a bonding shell, in channels
+            # where the residual is large enough for an atom to decrease the loss
+            residual_energy = (density_diff**2).sum(axis=0)
+            can_add = residual_energy > kernel_energy/4
+            xyz_next, c_next, bonds_new = \
+                get_next_atom(points, density_diff*can_add, xyz, c, atomic_radii, bonded, bonds,
+                              max_n_bonds, max_init_bond_E, points_tree)
+            if xyz_next is not None:
+                xyz_new.append(xyz_next)
+                c_new.append(c_next)
         else:
-            c_new = []
-            for i in range(n_channels):
-                conv = conv_grid(density_diff[:,i].reshape(grid_shape), kernels[i])
-                conv = np.roll(conv, np.array(grid_shape)//2, range(len(grid_shape)))
-                if np.any(conv > (kernels[i]**2).sum()/2): # check if L2 loss decreases
-                    xyz_new.append(points[conv.argmax()])
-                    c_new.append(i)
+            # only correlate channels where the residual is large enough for an atom to
+            # decrease the loss, and stop tracking channels without atoms once it isn't
+            residual_energy = (density_diff**2).sum(axis=0)
+            can_add = residual_energy > kernel_energy/4
+            active &= can_add | (np.bincount(c, minlength=n_channels) > 0)
+            channels_to_conv = np.flatnonzero(active & can_add)
+
+            idx_new = []
+            recompute = not incremental_conv or not np.all(conv_valid[channels_to_conv]) or \
+                np.any(np.linalg.norm(xyz - xyz_conv, axis=1) > conv_move_tol)
+            while len(channels_to_conv) > 0:
+                if recompute:
+                    convs[channels_to_conv] = conv_grids_spectra(
+                        density_diff[:,channels_to_conv].T.reshape((-1,) + grid_shape),
+                        kernel_spectra[channels_to_conv]
+                    )
+                    conv_valid[...] = False
+                    conv_valid[channels_to_conv] = True
+                    xyz_conv = np.array(xyz)
+                if multi_atom:
+                    idx_new, c_new = get_conv_peaks(convs[channels_to_conv], kernel_energy[channels_to_conv]/2,
+                                                    points, atomic_radii[channels_to_conv])
+                    c_new = list(channels_to_conv[c_new])
+                    xyz_new = list(points[idx_new])
+                else:
+                    for i in channels_to_conv:
+                        if np.any(convs[i] > kernel_energy[i]/2): # check if L2 loss decreases
+                            idx_new.append(convs[i].argmax())
+                            xyz_new.append(points[idx_new[-1]])
+                            c_new.append(i)
+                if xyz_new or recompute:
+                    break
+                recompute = True # make sure no atom can be added using exact correlations
 
         # stop if a new atom was not added
         if not xyz_new:
@@ -372,26 +1090,244 @@ def fit_atoms_to_grid(grid, channels, center, resolution, max_iter, lr, mo, lamb
         xyz = np.vstack([xyz, xyz_new])
         c = np.append(c, c_new)
 
+        if incremental_conv: # remove new atoms from residual correlations
+            for idx, i in zip(idx_new, c_new):
+                box, box_idx = conv_responses[i]
+                add_grid_box(convs[i], box, box_idx, np.unravel_index(idx, grid_shape), -1.0)
+            xyz_conv = np.vstack([xyz_conv, xyz_new])
+
         if bonded: # add new bonds as row and column
-            raise NotImplementedError('TODO add bonds_new')
             bonds = np.vstack([bonds, bonds_new])
-            bonds = np.hstack([bonds, np.append(bonds_new, 0)])
+            bonds = np.hstack([bonds, np.append(bonds_new, 0)[:,np.newaxis]])
 
     grid_pred = density_pred.T.reshape(grid.shape)
-    return xyz, c, bonds, grid_pred, loss, time.time() - t_start
+    return xyz, c, bonds, grid_pred, loss, time.time() - t_start, stats
 
 
-def get_next_atom(points, density, xyz_init, c, atom_radius, bonded, bonds, max_n_bonds, max_init_bond_E=0.5):
+def fit_atoms_to_grids(grids, channels, center, resolution, max_iter, lr, mo, radius_multiple=1.5,
+                       fit_channels=None, density_backend='piecewise', max_batch_points=2**20,
+                       max_batch_grids=4, time_budget=np.inf, iter_budget=np.inf, verbose=0):
+    '''
+    Fit atoms to a stack of grids with the same shape, center and resolution
+    the same way as fit_atoms_to_grid with its default options, but run the
+    gradient descent and atom placement steps of all grids in lockstep. The
+    atoms of each grid are kept in padded arrays, and the density and gradient
+    of the atoms of every grid that has not converged are evaluated at once
+    within their cutoff windows, at most max_batch_points atom-point pairs at
+    a time. The residual densities of all grids that are still placing atoms
+    are correlated with the kernels in one batched FFT. To bound memory, the
+    grids are fit in chunks of at most max_batch_grids grids, each with its own
+    budgets. The same fit_channels, if any, are fit to each grid. Grids that run
+    out of time_budget or iter_budget stop with their lowest loss atoms fit so
+    far. Return a list of the results of fit_atoms_to_grid for each grid.
+    '''
+    if len(grids) > max_batch_grids: # fit each chunk of grids in lockstep
+        return [result for l in range(0, len(grids), max_batch_grids) \
+                    for result in fit_atoms_to_grids(grids[l:l+max_batch_grids], channels, center,
+                        resolution, max_iter, lr, mo, radius_multiple, fit_channels, density_backend,
+                        max_batch_points, max_batch_grids, time_budget, iter_budget, verbose)]
+
+    t_start = time.time()
+    backend = density_backends[density_backend]
+
+    n_grids, n_channels, grid_shape = grids.shape[0], grids.shape[1], grids.shape[2:]
+    atomic_radii = np.array([c.atomic_radius for c in channels])
+
+    # convert grids to arrays of xyz points and channel density values
+    points = get_grid_points(grid_shape, center, resolution)
+    origin = points[0]
+    n_points = len(points)
+    density = np.ascontiguousarray(grids.reshape((n_grids, n_channels, -1)).transpose(0, 2, 1))
+    density_pred = np.zeros_like(density)
+    density_diff = np.zeros_like(density)
+
+    # the predicted density is only accumulated at the points in atom windows,
+    # so the loss at other points is the energy of the density outside them
+    density_flat = density.ravel()
+    density_energy = (density.astype(float)**2).sum(axis=(1, 2))
+    window_slot = np.zeros(density.size, dtype=int)
+
+    # init atom density kernels and their spectra
+    kernels = [get_atom_density_kernel(grid_shape, resolution, r, radius_multiple, density_backend) \
+               for r in atomic_radii]
+    kernel_energy = np.array([(k**2).sum() for k in kernels])
+    kernel_spectra = get_atom_density_kernel_spectra(grid_shape, resolution, tuple(atomic_radii),
+                                                     radius_multiple, density_backend)
+    separable = backend.grid_density is not None
+    cutoff = backend.cutoff(np.max(atomic_radii), radius_multiple)
+    width = int(2*cutoff/resolution) + 1
+    max_n_idx = width**len(grid_shape)
+    batch_size = max(max_batch_points//max_n_idx, 1)
+
+    # atoms of each grid padded to the most atoms in any grid
+    xyz = np.zeros((n_grids, 0, 3))
+    c = np.zeros((n_grids, 0), dtype=int)
+    n_atoms = np.zeros(n_grids, dtype=int)
+    loss = np.full(n_grids, np.inf)
+    n_iters = np.zeros(n_grids, dtype=int)
+    n_evals = np.zeros(n_grids, dtype=int)
+    converged = np.zeros(n_grids, dtype=bool)
+    truncated = np.zeros(n_grids, dtype=bool)
+    active = np.ones((n_grids, n_channels), dtype=bool)
+    fitting = np.ones(n_grids, dtype=bool)
+    deadline = t_start + time_budget
+    if np.isfinite(time_budget) or np.isfinite(iter_budget):
+        best_fits = [None for _ in range(n_grids)]
+
+    ax = np.newaxis
+    while np.any(fitting):
+
+        # optimize atom positions of grids that are still fitting by gradient descent
+        descending = np.flatnonzero(fitting)
+        loss[descending] = np.inf
+        d_loss_d_xyz = np.zeros_like(xyz)
+        i = 0
+        while len(descending) > 0:
+            loss_prev = loss[descending]
+
+            # atoms of descending grids, where k indexes into descending
+            k, j = np.nonzero(np.arange(xyz.shape[1]) < n_atoms[descending,ax])
+            b = descending[k]
+            n = len(b)
+            atom_idx, in_grid, atom_lo = get_grid_windows(xyz[b,j], cutoff, grid_shape, origin, resolution)
+            atom_density = np.zeros((n, max_n_idx))
+            atom_gradient = np.zeros((n, max_n_idx, 3))
+            for l in range(0, n, batch_size):
+                batch = slice(l, l+batch_size)
+                if separable: # window axes start at the first point of each window
+                    axes = [origin[m] + resolution*(atom_lo[batch,m,ax] + np.arange(width)) \
+                                for m in range(len(grid_shape))]
+                    backend.grid_density_and_gradient(xyz[b[batch],j[batch]], atomic_radii[c[b[batch],j[batch]]],
+                                                      axes, atom_density[batch], atom_gradient[batch])
+                else:
+                    backend.density_and_gradient(xyz[b[batch],j[batch],ax,:], atomic_radii[c[b[batch],j[batch]],ax],
+                                                 points[atom_idx[batch]], radius_multiple,
+                                                 atom_density[batch], atom_gradient[batch])
+            if not in_grid.all():
+                atom_density *= in_grid
+                atom_gradient *= in_grid[:,:,ax]
+
+            # flat indices into density arrays of shape (n_grids, n_points, n_channels)
+            window_idx = (b[:,ax]*n_points + atom_idx)*n_channels + c[b,j,ax]
+
+            # accumulate window densities at the distinct window points, found by letting
+            # every window entry write its index to its point and reading back the winner
+            flat_idx = window_idx.ravel()
+            window_entries = np.arange(len(flat_idx))
+            window_slot[flat_idx] = window_entries
+            entry_slot = window_slot[flat_idx]
+            entry_pred = np.bincount(entry_slot, weights=atom_density.ravel(), minlength=len(flat_idx))
+            is_slot = entry_slot == window_entries
+            slot_idx = flat_idx[is_slot]
+            slot_pred = entry_pred[is_slot]
+            slot_density = density_flat[slot_idx].astype(float)
+            slot_b = slot_idx//(n_points*n_channels)
+            slot_energy = np.bincount(slot_b, weights=slot_density**2, minlength=n_grids)
+            slot_loss = np.bincount(slot_b, weights=(slot_density - slot_pred)**2, minlength=n_grids)
+            loss[descending] = np.maximum(density_energy - slot_energy, 0.0)[descending] + slot_loss[descending]
+            window_diff = (density_flat[flat_idx] - entry_pred[entry_slot]).reshape(window_idx.shape)
+            n_evals[descending] += 1
+
+            # grids whose loss converged stop descending, keeping their predicted density
+            delta_loss = loss[descending] - loss_prev
+            converged[descending] = np.abs(delta_loss)/(np.abs(loss_prev) + 1e-8) < 1e-2
+            out_of_budget = (time.time() > deadline) | (n_iters[descending] + i >= iter_budget)
+            truncated[descending] |= out_of_budget
+            done = converged[descending] | (n_atoms[descending] == 0) | (i == max_iter) | out_of_budget
+            n_iters[descending[done]] += i
+            if np.any(done): # fill in the predicted density and difference at every point
+                for d in descending[done]:
+                    density_pred[d] = 0.0
+                done_slot = np.isin(slot_b, descending[done])
+                np.put(density_pred, slot_idx[done_slot], slot_pred[done_slot])
+                for d in descending[done]:
+                    np.subtract(density[d], density_pred[d], out=density_diff[d])
+            descending = descending[~done]
+            if verbose > 2:
+                print('n_grids = {}\titer = {}\tmean loss = {}'.format(len(loss_prev), i, loss_prev.mean()),
+                      file=sys.stderr)
+
+            # compute derivatives and descend loss gradient for atoms of grids still descending
+            d_loss_d_xyz_prev = d_loss_d_xyz[b,j]
+            d_loss_d_xyz[b,j] = -2*np.einsum('ij,ijk->ik', window_diff, atom_gradient)
+            step = ~done[k]
+            xyz[b[step],j[step]] -= lr*(mo*d_loss_d_xyz_prev[step] + (1-mo)*d_loss_d_xyz[b[step],j[step]])
+            i += 1
+
+        if np.isfinite(time_budget) or np.isfinite(iter_budget): # keep lowest loss fit of each grid
+            for b in np.flatnonzero(fitting):
+                if best_fits[b] is None or loss[b] < best_fits[b][-1]:
+                    best_fits[b] = xyz[b,:n_atoms[b]].copy(), c[b,:n_atoms[b]].copy(), \
+                                   density_pred[b].copy(), loss[b]
+
+        # init next atom positions on remaining density of each grid, by correlating
+        # the residual density of each grid and channel to place atoms in at once
+        fitting &= ~truncated
+        conv_b = []
+        conv_i = []
+        for b in np.flatnonzero(fitting):
+
+            if verbose > 1:
+                print('grid = {}\tn_atoms = {}\t\tloss = {}'.format(b, n_atoms[b], loss[b]))
+
+            if fit_channels is not None:
+                channels_to_conv = fit_channels[n_atoms[b]:n_atoms[b]+1]
+            else:
+                residual_energy = (density_diff[b]**2).sum(axis=0)
+                can_add = residual_energy > kernel_energy/4
+                active[b] &= can_add | (np.bincount(c[b,:n_atoms[b]], minlength=n_channels) > 0)
+                channels_to_conv = np.flatnonzero(active[b] & can_add)
+            conv_b.extend([b]*len(channels_to_conv))
+            conv_i.extend(channels_to_conv)
+
+        new_atoms = dict()
+        if conv_b:
+            convs = conv_grids_spectra(density_diff[conv_b,:,conv_i].reshape((-1,) + grid_shape),
+                                       kernel_spectra[conv_i])
+            for b, i, conv in zip(conv_b, conv_i, convs):
+                if fit_channels is not None or np.any(conv > kernel_energy[i]/2): # check if L2 loss decreases
+                    xyz_new, c_new = new_atoms.setdefault(b, ([], []))
+                    xyz_new.append(points[conv.argmax()])
+                    c_new.append(i)
+
+        # stop fitting grids where a new atom was not added
+        fitting[[b for b in np.flatnonzero(fitting) if b not in new_atoms]] = False
+
+        # pad atom arrays to fit the new atoms
+        if new_atoms:
+            n_pad = max(n_atoms[b] + len(c_new) for b, (xyz_new, c_new) in new_atoms.items()) - xyz.shape[1]
+            if n_pad > 0:
+                xyz = np.concatenate([xyz, np.zeros((n_grids, n_pad, 3))], axis=1)
+                c = np.concatenate([c, np.zeros((n_grids, n_pad), dtype=int)], axis=1)
+        for b, (xyz_new, c_new) in new_atoms.items():
+            xyz[b,n_atoms[b]:n_atoms[b]+len(c_new)] = xyz_new
+            c[b,n_atoms[b]:n_atoms[b]+len(c_new)] = c_new
+            n_atoms[b] += len(c_new)
+
+    t = time.time() - t_start
+    results = []
+    for b in range(n_grids):
+        if truncated[b]:
+            xyz_b, c_b, density_pred_b, loss_b = best_fits[b]
+        else:
+            xyz_b, c_b, density_pred_b, loss_b = xyz[b,:n_atoms[b]], c[b,:n_atoms[b]], density_pred[b], loss[b]
+        grid_pred = density_pred_b.T.reshape(grids.shape[1:])
+        stats = dict(n_iters=n_iters[b], n_evals=n_evals[b], converged=converged[b], truncated=truncated[b])
+        results.append((xyz_b, c_b, np.ndarray((0, 0)), grid_pred, loss_b, t, stats))
+    return results
+
+
+def get_next_atom(points, density, xyz_init, c, atom_radius, bonded, bonds, max_n_bonds, max_init_bond_E=0.5,
+                  points_tree=None):
     '''
     Get next atom tuple (xyz_new, c_new, bonds_new) of initial position,
     channel index, and bonds to other atoms. Select the atom as maximum
     density point within some distance range from the other atoms, given
-    by positions xyz_init and channel indices c.
+    by positions xyz_init and channel indices c. A cKDTree of the points
+    can be provided to avoid rebuilding it on each call.
     '''
-    xyz_new = None
-    c_new = None
-    bonds_new = None
-    d_max = 0.0
+    n_atoms = len(xyz_init)
+    n_channels = density.shape[1]
 
     if bonded:
         # bond_length2[i,j] = length^2 of bond between channel[i] and channel[j]
@@ -402,49 +1338,52 @@ def get_next_atom(points, density, xyz_init, c, atom_radius, bonded, bonds, max_
     # can_bond[i] = xyz_init[i] has less than its max number of bonds
     can_bond = np.sum(bonds, axis=1) < max_n_bonds[c]
 
-    for p, d in zip(points, density):
+    # in_range[p,j] = point p is far enough from all xyz_init and near enough to
+    # some xyz_init that can bond to make a bond in channel[j]
+    if n_atoms == 0:
+        in_range = np.ones(density.shape, dtype=bool)
 
-        # more_density[i] = p has more density in channel[i] than best point so far
-        more_density = d > d_max
-        if np.any(more_density):
-
-            if len(xyz_init) == 0:
-                xyz_new = p
-                c_new = np.argmax(d)
-                bonds_new = np.array([])
-                d_max = d[c_new]
-
-            else:
-                # dist2[i] = distance^2 between p and xyz_init[i]
-                dist2 = np.sum((p[np.newaxis,:] - xyz_init)**2, axis=1)
-
-                # dist_min2[i,j] = min distance^2 between p and xyz_init[i] in channel[j]
-                # dist_max2[i,j] = max distance^2 between p and xyz_init[i] in channel[j]
-                if bonded:
-                    dist_min2 = min_bond_length2[c]
-                    dist_max2 = max_bond_length2[c]
-                else:
-                    dist_min2 = atom_radius[c,np.newaxis]
-                    dist_max2 = np.full_like(dist_min2, np.inf)
-
-                # far_enough[i,j] = p is far enough from xyz_init[i] in channel[j]
-                # near_enough[i,j] = p is near enough to xyz_init[i] in channel[j]
-                far_enough = dist2[:,np.newaxis] > dist_min2
-                near_enough = dist2[:,np.newaxis] < dist_max2
-
-                # in_range[i] = p is far enough from all xyz_init and near_enough to
-                # some xyz_init that can bond to make a bond in channel[i]
-                in_range = np.all(far_enough, axis=0) & \
-                           np.any(near_enough & can_bond[:,np.newaxis], axis=0)
-
-                if np.any(in_range & more_density):
-                    xyz_new = p
-                    c_new = np.argmax(in_range*more_density*d)
-                    if bonded:
-                        bonds_new = near_enough[:,c_new] & can_bond
-                    else:
-                        bonds_new = np.zeros(len(xyz_init))
-                    d_max = d[c_new]
+    else:
+        # dist_min2[i,j] = min distance^2 between a point and xyz_init[i] in channel[j]
+        # dist_max2[i,j] = max distance^2 between a point and xyz_init[i] in channel[j]
+        if bonded:
+            dist_min2 = min_bond_length2[c]
+            dist_max2 = max_bond_length2[c]
+        else:
+            dist_min2 = np.broadcast_to(atom_radius[c,np.newaxis], (n_atoms, n_channels))
+            dist_max2 = np.full_like(dist_min2, np.inf)
+
+        # only points within the largest finite distance range of each atom need to be checked
+        if points_tree is None:
+            points_tree = cKDTree(points)
+        search_dist2 = np.where(np.isfinite(dist_max2), dist_max2, dist_min2).max(axis=1)
+        too_close = np.zeros(density.shape, dtype=bool)
+        near_enough = np.zeros(density.shape, dtype=bool)
+        for i in range(n_atoms):
+            nbrs = np.array(points_tree.query_ball_point(xyz_init[i], np.sqrt(search_dist2[i])), dtype=int)
+            dist2 = np.sum((points[nbrs] - xyz_init[i])**2, axis=1)[:,np.newaxis]
+            too_close[nbrs] |= dist2 <= dist_min2[i]
+            if can_bond[i]:
+                near_enough[nbrs] |= dist2 < dist_max2[i]
+
+        # points beyond the search distance are near enough to atoms without a max distance
+        near_enough |= np.any(np.isinf(dist_max2) & can_bond[:,np.newaxis], axis=0)
+        in_range = ~too_close & near_enough
+
+    # select the maximum positive density point and channel that is in range
+    masked_density = np.where(in_range & (density > 0.0), density, 0.0)
+    p_new, c_new = np.unravel_index(masked_density.argmax(), density.shape)
+    if masked_density[p_new,c_new] == 0.0:
+        return None, None, None
+
+    xyz_new = points[p_new]
+    if n_atoms == 0:
+        bonds_new = np.array([])
+    elif bonded:
+        dist2 = np.sum((xyz_new - xyz_init)**2, axis=1)
+        bonds_new = (dist2 < max_bond_length2[c,c_new]) & can_bond
+    else:
+        bonds_new = np.zeros(n_atoms)
 
     return xyz_new, c_new, bonds_new
 
@@ -553,22 +1492,103 @@ def write_pymol_script(pymol_file, dx_prefixes, struct_files, centers=[]):
             f.write('translate [{},{},{}], {}, camera=0\n'.format(-x, -y, -z, obj_name))
 
 
-def read_gninatypes_file(lig_file, channels):
+gninatypes_dtype = np.dtype([('xyz', '<f4', 3), ('type', '<i4')])
+gninatypes_cache = cache_util.LRUCache(maxsize=1024)
+
+
+@cache_util.lru_cache(maxsize=16)
+def get_smina_type_channel_index(channel_names):
+    '''
+    Return a read-only array of the index of the first channel with
+    the name of each smina type, or -1 if there is no such channel.
+    '''
+    channel_name_idx = dict()
+    for i, n in enumerate(channel_names):
+        channel_name_idx.setdefault(n, i)
+    return cache_util.read_only(np.array([channel_name_idx.get(t.name, -1) for t in atom_types.smina_types]))
+
+
+def read_gninatypes_file(lig_file, channels, store=None):
+    '''
+    Return read-only arrays of the positions and channel indices of
+    the atoms in a .gninatypes file whose types are in channels. If the
+    file is in a packed gninatypes_store, its atoms are read from there,
+    otherwise reads are cached by file path and modification time.
+    '''
+    channel_names = tuple(c.name for c in channels)
+    if store is not None and os.path.abspath(lig_file) in store.index:
+        atoms = get_gninatypes_store_atoms(store, lig_file)
+        return get_gninatypes_xyz_c(atoms, channel_names)
+
+    key = (lig_file, os.path.getmtime(lig_file), channel_names)
+    try:
+        return gninatypes_cache[key]
+    except KeyError:
+        pass
+
+    atoms = np.fromfile(lig_file, dtype=gninatypes_dtype)
+    value = gninatypes_cache[key] = get_gninatypes_xyz_c(atoms, channel_names)
+    return value
+
+
+def get_gninatypes_xyz_c(atoms, channel_names):
+    '''
+    Return read-only arrays of the positions and channel indices of an
+    array of gninatypes atoms whose types are in channel_names.
+    '''
+    c = get_smina_type_channel_index(channel_names)[atoms['type']]
+    in_channels = c >= 0
+    xyz = atoms['xyz'][in_channels].astype(float)
+    return cache_util.read_only(xyz), cache_util.read_only(c[in_channels])
+
+
+gninatypes_store = namedtuple('gninatypes_store', ['atoms', 'offsets', 'index'])
+
+
+def pack_gninatypes_files(data_file, data_root, store_prefix):
+    '''
+    Pack the atoms of the .gninatypes files of the ligands in data_file,
+    relative to data_root, into one contiguous array of gninatypes_dtype
+    saved to store_prefix.atoms.npy. The offsets of each ligand's atoms in
+    the array are saved to store_prefix.offsets.npy, and the ligand file
+    paths relative to data_root to store_prefix.lig_files, one per line in
+    the same order.
+    '''
+    lig_files = []
+    for rec_file, lig_file in read_examples_from_data_file(data_file):
+        lig_files.append(os.path.normpath(os.path.splitext(lig_file)[0] + '.gninatypes'))
+    lig_files = sorted(set(lig_files))
+
+    atoms = [np.fromfile(os.path.join(data_root, f), dtype=gninatypes_dtype) for f in lig_files]
+    offsets = np.cumsum([0] + [len(a) for a in atoms])
+    np.save(store_prefix + '.atoms.npy', np.concatenate(atoms) if atoms else np.zeros(0, gninatypes_dtype))
+    np.save(store_prefix + '.offsets.npy', offsets)
+    with open(store_prefix + '.lig_files', 'w') as f:
+        f.write(''.join(l + '\n' for l in lig_files))
+
+
+@cache_util.lru_cache(maxsize=4)
+def load_gninatypes_store(store_prefix, data_root=''):
+    '''
+    Load a gninatypes_store packed by pack_gninatypes_files, with its
+    atom array memory-mapped read-only so that the page cache is shared
+    by every process that loads it. Ligand files are indexed by their
+    absolute path, resolved relative to data_root.
+    '''
+    atoms = np.load(store_prefix + '.atoms.npy', mmap_mode='r')
+    offsets = np.load(store_prefix + '.offsets.npy')
+    with open(store_prefix + '.lig_files') as f:
+        index = {os.path.abspath(os.path.join(data_root, l)): i for i, l in enumerate(f.read().splitlines())}
+    return gninatypes_store(atoms, offsets, index)
+
 
-    channel_names = [c.name for c in channels]
-    channel_name_idx = {n: i for i, n in enumerate(channel_names)}
-    xyz, c = [], []
-    with open(lig_file, 'rb') as f:
-        atom_bytes = f.read(16)
-        while atom_bytes:
-            x, y, z, t = struct.unpack('fffi', atom_bytes)
-            smina_type = atom_types.smina_types[t]
-            if smina_type.name in channel_name_idx:
-                c_ = channel_names.index(smina_type.name)
-                xyz.append([x, y, z])
-                c.append(c_)
-            atom_bytes = f.read(16)
-    return np.array(xyz), np.array(c)
+def get_gninatypes_store_atoms(store, lig_file):
+    '''
+    Return a read-only view of the atoms of a ligand file in a
+    gninatypes_store, without copying them.
+    '''
+    i = store.index[os.path.abspath(lig_file)]
+    return store.atoms[store.offsets[i]:store.offsets[i+1]]
 
 
 def read_mols_from_sdf_file(sdf_file):
@@ -666,13 +1686,17 @@ def write_xyz_elems_bonds_to_sdf_file(sdf_file, xyz_elems_bonds):
     out.close()
 
 
+dx_line_format = '%.10f %.10f %.10f\n'
+dx_chunk_lines = 2**14
+
+
 def write_grid_to_dx_file(dx_file, grid, center, resolution):
     '''
     Write a grid with a center and resolution to a .dx file.
     '''
     dim = grid.shape[0]
     origin = np.array(center) - resolution*(dim-1)/2.
-    with open(dx_file, 'w') as f:
+    with open(dx_file, 'w', 2**20) as f:
         f.write('object 1 class gridpositions counts %d %d %d\n' % (dim, dim, dim))
         f.write('origin %.5f %.5f %.5f\n' % tuple(origin))
         f.write('delta %.5f 0 0\n' % resolution)
@@ -680,16 +1704,13 @@ def write_grid_to_dx_file(dx_file, grid, center, resolution):
         f.write('delta 0 0 %.5f\n' % resolution)
         f.write('object 2 class gridconnections counts %d %d %d\n' % (dim, dim, dim))
         f.write('object 3 class array type double rank 0 items [ %d ] data follows\n' % (dim**3))
-        total = 0
-        for i in range(dim):
-            for j in range(dim):
-                for k in range(dim):
-                    f.write('%.10f' % grid[i][j][k])
-                    total += 1
-                    if total % 3 == 0:
-                        f.write('\n')
-                    else:
-                        f.write(' ')
+        values = np.asarray(grid, dtype=float).ravel().tolist()
+        n_lines = len(values)//3
+        for i in range(0, n_lines, dx_chunk_lines): # three values per line
+            n = min(dx_chunk_lines, n_lines - i)
+            f.write(dx_line_format*n % tuple(values[3*i:3*(i+n)]))
+        n = len(values) - 3*n_lines
+        f.write('%.10f '*n % tuple(values[3*n_lines:]))
 
 
 def write_grids_to_dx_files(out_prefix, grids, channels, center, resolution):
@@ -766,17 +1787,35 @@ def min_RMSD(xyz1, xyz2, c):
     positions of a given type. Returns the minimum RMSD across
     all permutations of this mapping.
     '''
-    xyz1 = np.array(xyz1)
-    xyz2 = np.array(xyz2)
+    return min_RMSDs(xyz1, [xyz2], c)[0][0]
+
+
+def min_RMSDs(xyz_ref, xyzs, c):
+    '''
+    Compute min_RMSD between a reference set of atom positions and each
+    of a stack of sets of positions of the same atom types c, or between
+    corresponding sets if the reference is also a stack. Atoms are grouped
+    by type once, and the squared distances between atoms of each type are
+    computed for all sets at once. Returns an array of the RMSDs, and an
+    array of the index of the reference atom mapped to each atom of each set.
+    '''
+    xyzs = np.array(xyzs, dtype=float).reshape((-1, len(c), 3))
+    xyz_ref = np.broadcast_to(np.array(xyz_ref, dtype=float), xyzs.shape)
     c = np.array(c)
-    ssd = 0.0
-    for c_ in sorted(set(c)):
-        xyz1_c = xyz1[c == c_]
-        xyz2_c = xyz2[c == c_]
-        dist2_c = ((xyz1_c[:,np.newaxis,:] - xyz2_c[np.newaxis,:,:])**2).sum(axis=2)
-        idx1, idx2 = sp.optimize.linear_sum_assignment(dist2_c)
-        ssd += ((xyz1_c[idx1] - xyz2_c[idx2])**2).sum()
-    return np.sqrt(ssd/len(c))
+    ssd = np.zeros(len(xyzs))
+    mapping = np.zeros((len(xyzs), len(c)), dtype=int)
+    for c_ in np.unique(c):
+        idx_c = np.flatnonzero(c == c_)
+        dist2_c = ((xyz_ref[:,idx_c,np.newaxis,:] - xyzs[:,np.newaxis,idx_c,:])**2).sum(axis=3)
+        if len(idx_c) == 1:
+            ssd += dist2_c[:,0,0]
+            mapping[:,idx_c] = idx_c
+            continue
+        for i in range(len(xyzs)):
+            idx1, idx2 = sp.optimize.linear_sum_assignment(dist2_c[i])
+            ssd[i] += dist2_c[i,idx1,idx2].sum()
+            mapping[i,idx_c[idx2]] = idx_c[idx1]
+    return np.sqrt(ssd/len(c)), mapping
 
 
 def find_blobs_in_net(net, blob_pattern):
@@ -817,13 +1856,35 @@ def generate_from_model(data_net, gen_net, data_param, examples, metric_df, metr
     out_thread.start()
 
     if args.fit_atoms: # fit atoms to grids in separate processes
+
+        # cache kernel spectra before forking so that they are shared by workers
+        grid_shape = tuple(gen_net.blobs['lig'].shape[2:])
+        get_atom_density_kernel_spectra(grid_shape, resolution,
+                                        tuple(c.atomic_radius for c in channels),
+                                        radius_multiple, args.density_backend)
+        if args.deconv_fit:
+            get_wiener_filter_bank(grid_shape, resolution,
+                                   tuple(c.atomic_radius for c in channels),
+                                   radius_multiple, args.noise_ratio, args.density_backend)
+
         fit_queue = mp.Queue(args.n_fit_workers) # queue for atom fitting
+        if args.fit_cache_size > 0 or args.fit_cache_dir: # cache of fit results shared by workers
+            cache_manager = cache_util.CacheManager()
+            cache_manager.start()
+            fit_cache = cache_manager.LRUCache(max(args.fit_cache_size, 1))
+        else:
+            fit_cache = None
         fit_pool = mp.Pool(
             processes=args.n_fit_workers,
             initializer=fit_worker_main,
-            initargs=(fit_queue, out_queue)
+            initargs=(fit_queue, out_queue, fit_cache, mp.Lock(), args.fit_cache_dir, args.fit_cache_timeout)
         )
 
+    if args.lig_store: # packed ligand atoms to read instead of .gninatypes files
+        lig_store = load_gninatypes_store(args.lig_store, args.data_root)
+    else:
+        lig_store = None
+
     # generate density grids from generative model in main thread
     for example_idx, (rec_file, lig_file) in enumerate(examples):
 
@@ -833,7 +1894,7 @@ def generate_from_model(data_net, gen_net, data_param, examples, metric_df, metr
         lig_prefix, lig_ext = os.path.splitext(lig_file)
         lig_name = os.path.basename(lig_prefix)
 
-        lig_xyz, lig_c = read_gninatypes_file(lig_prefix + '.gninatypes', channels)
+        lig_xyz, lig_c = read_gninatypes_file(lig_prefix + '.gninatypes', channels, lig_store)
 
         if fix_center_to_origin:
             center = np.zeros(3)
@@ -853,7 +1914,35 @@ def generate_from_model(data_net, gen_net, data_param, examples, metric_df, metr
                                 max_init_bond_E=args.max_init_bond_E,
                                 fit_channels=lig_c if args.fit_atom_types else None,
                                 lr=args.learning_rate,
-                                mo=args.momentum)
+                                mo=args.momentum,
+                                density_backend=args.density_backend,
+                                max_batch_points=args.max_batch_points,
+                                incremental=args.incremental_fit,
+                                incremental_conv=args.incremental_conv,
+                                multi_atom=args.multi_atom,
+                                optimizer=args.optimizer,
+                                coarsen=args.coarsen_fit,
+                                time_budget=args.fit_time_budget,
+                                iter_budget=args.fit_iter_budget,
+                                deconv_fit=args.deconv_fit,
+                                noise_ratio=args.noise_ratio)
+            if args.batch_fit:
+                fit_atoms = partial(fit_atoms_to_grids,
+                                    channels=channels,
+                                    center=center,
+                                    resolution=resolution,
+                                    max_iter=args.max_iter,
+                                    radius_multiple=radius_multiple,
+                                    verbose=args.verbose,
+                                    fit_channels=lig_c if args.fit_atom_types else None,
+                                    lr=args.learning_rate,
+                                    mo=args.momentum,
+                                    density_backend=args.density_backend,
+                                    max_batch_points=args.max_batch_points,
+                                    max_batch_grids=args.max_batch_grids,
+                                    time_budget=args.fit_time_budget,
+                                    iter_budget=args.fit_iter_budget)
+                lig_grids = defaultdict(list)
 
         for sample_idx in range(args.n_samples):
 
@@ -887,24 +1976,88 @@ def generate_from_model(data_net, gen_net, data_param, examples, metric_df, metr
                 grid = np.array(gen_net.blobs[blob_name].data[batch_idx])
                 print('main_thread produced {} {} {}'.format(lig_name, blob_name, sample_idx))
 
-                if args.fit_atoms:
+                if args.fit_atoms and args.batch_fit:
+                    lig_grids[blob_name].append(grid)
+                elif args.fit_atoms:
                     fit_queue.put((lig_name, sample_idx, blob_name, center, grid, fit_atoms))
                 else:
-                    out_queue.put((lig_name, sample_idx, blob_name, center, grid, None, None))
+                    out_queue.put((lig_name, sample_idx, blob_name, center, grid, None, None, None))
+
+        if args.fit_atoms and args.batch_fit: # fit all samples of each blob at once
+            for blob_name in args.blob_name:
+                fit_queue.put((lig_name, range(args.n_samples), blob_name, center,
+                               np.array(lig_grids[blob_name]), fit_atoms))
 
     out_thread.join()
 
 
-def fit_worker_main(fit_queue, out_queue):
+FIT_PENDING = 'pending' # fit_cache value of a fit in progress
+
+
+def fit_atoms_cached(fit_atoms, grid, fit_cache, fit_lock, disk_cache=None, timeout=np.inf):
+    '''
+    Call fit_atoms on grid, or return the result of a previous call with an
+    identical grid and fit parameters from fit_cache, or disk_cache if given.
+    Caches are keyed by a hash of the grid and the partial fit_atoms keywords.
+    If another process sharing the caches and fit_lock is already fitting an
+    identical grid, wait for its result instead, or fit the grid anyway after
+    waiting timeout seconds, in case that process died.
+    '''
+    key = cache_util.hash_values(grid, fit_atoms.func.__name__, fit_atoms.keywords)
+    deadline = time.time() + timeout
+    while True:
+        with fit_lock:
+            result = fit_cache.get(key)
+            if result is None and disk_cache is not None:
+                result = disk_cache.get(key)
+                if result is not None:
+                    fit_cache[key] = result
+            if result is None or (isinstance(result, str) and time.time() > deadline): # claim the fit
+                fit_cache[key] = FIT_PENDING
+                break
+        if not isinstance(result, str):
+            return result
+        time.sleep(0.1)
+
+    try:
+        result = fit_atoms(grid)
+    except:
+        fit_cache.pop(key)
+        raise
+
+    fit_cache[key] = result
+    if disk_cache is not None:
+        disk_cache[key] = result
+    return result
+
+
+def fit_worker_main(fit_queue, out_queue, fit_cache=None, fit_lock=None, fit_cache_dir=None,
+                    fit_cache_timeout=np.inf):
+
+    if fit_cache is not None and fit_cache_dir:
+        disk_cache = cache_util.DiskCache(fit_cache_dir)
+    else:
+        disk_cache = None
 
     while True:
         print('fit_worker waiting')
         lig_name, sample_idx, grid_name, center, grid, fit_atoms = fit_queue.get()
         print('fit_worker got {} {} {}'.format(lig_name, grid_name, sample_idx))
-        out_queue.put((lig_name, sample_idx, grid_name, center, grid, None, None))
-        xyz, c, bonds, grid_fit, loss, t = fit_atoms(grid)
-        print('fit_worker produced {} {} {}'.format(lig_name, grid_name, sample_idx))
-        out_queue.put((lig_name, sample_idx, grid_name + '_fit', center, grid_fit, xyz, c))
+
+        batched = isinstance(sample_idx, list) # stack of grids for a batch of samples
+        sample_idxs, grids = (sample_idx, grid) if batched else ([sample_idx], [grid])
+        for sample_idx, grid in zip(sample_idxs, grids):
+            out_queue.put((lig_name, sample_idx, grid_name, center, grid, None, None, None))
+
+        if fit_cache is not None:
+            fit_atoms = partial(fit_atoms_cached, fit_atoms, fit_cache=fit_cache, fit_lock=fit_lock,
+                                disk_cache=disk_cache, timeout=fit_cache_timeout)
+        results = fit_atoms(grids) if batched else [fit_atoms(grid)]
+        for sample_idx, (xyz, c, bonds, grid_fit, loss, t, stats) in zip(sample_idxs, results):
+            print('fit_worker produced {} {} {} ({} atoms, {} iters, {} evals, converged = {}, truncated = {}, {:.2f}s)'.format(
+                lig_name, grid_name, sample_idx, len(xyz), stats['n_iters'], stats['n_evals'], stats['converged'],
+                stats['truncated'], t))
+            out_queue.put((lig_name, sample_idx, grid_name + '_fit', center, grid_fit, xyz, c, dict(stats, time=t)))
 
 
 def out_worker_main(out_queue, n_ligands, channels, resolution, metric_df, metric_file, pymol_file, args):
@@ -922,8 +2075,8 @@ def out_worker_main(out_queue, n_ligands, channels, resolution, metric_df, metri
     all_data = defaultdict(list) # group by lig_name
     while n_finished < n_ligands:
         print('out_worker waiting')
-        lig_name, sample_idx, grid_name, center, grid, xyz, c = out_queue.get()
-        all_data[lig_name].append((lig_name, sample_idx, grid_name, center, grid, xyz, c))
+        lig_name, sample_idx, grid_name, center, grid, xyz, c, fit_stats = out_queue.get()
+        all_data[lig_name].append((lig_name, sample_idx, grid_name, center, grid, xyz, c, fit_stats))
         print('out_worker got {} {} {}'.format(lig_name, grid_name, sample_idx))
 
         for lig_name, lig_data in all_data.items():
@@ -935,9 +2088,11 @@ def out_worker_main(out_queue, n_ligands, channels, resolution, metric_df, metri
 
             lig_grids = defaultdict(lambda: [None for _ in range(args.n_samples)])
             lig_xyzs  = defaultdict(lambda: [None for _ in range(args.n_samples)])
+            lig_cs    = defaultdict(lambda: [None for _ in range(args.n_samples)])
+            lig_fit_stats = defaultdict(lambda: [None for _ in range(args.n_samples)])
 
             for grid_data in lig_data: # unpack and write out grid data
-                lig_name, sample_idx, grid_name, center, grid, xyz, c = grid_data
+                lig_name, sample_idx, grid_name, center, grid, xyz, c, fit_stats = grid_data
 
                 grid_prefix = '{}_{}_{}_{}'.format(args.out_prefix, lig_name, grid_name, sample_idx)
                 lig_grids[grid_name][sample_idx] = grid
@@ -947,6 +2102,8 @@ def out_worker_main(out_queue, n_ligands, channels, resolution, metric_df, metri
                 
                 if xyz is not None:
                     lig_xyzs[grid_name][sample_idx] = xyz
+                    lig_cs[grid_name][sample_idx] = c
+                    lig_fit_stats[grid_name][sample_idx] = fit_stats
 
                     if args.output_sdf:
                         fit_file = '{}.sdf'.format(grid_prefix)
@@ -961,6 +2118,16 @@ def out_worker_main(out_queue, n_ligands, channels, resolution, metric_df, metri
 
             # compute generative metrics
             mean_grids = {n: np.mean(lig_grids[n], axis=0) for n in lig_grids}
+            if args.fit_atom_types: # fit structure quality, with the same atom types in each fit
+                # truncated fits may be missing atoms, so their RMSD is undefined
+                complete = [i for i in range(args.n_samples) if not lig_fit_stats['lig_fit'][i]['truncated'] \
+                            and not lig_fit_stats['lig_gen_fit'][i]['truncated']]
+                lig_gen_RMSDs = np.full(args.n_samples, np.nan)
+                if complete:
+                    lig_gen_RMSDs[complete], _ = min_RMSDs([lig_xyzs['lig_fit'][i] for i in complete],
+                                                           [lig_xyzs['lig_gen_fit'][i] for i in complete],
+                                                           lig_cs['lig_fit'][complete[0]])
+
             for i in range(args.n_samples):
 
                 lig = lig_grids['lig'][i]
@@ -983,15 +2150,19 @@ def out_worker_main(out_queue, n_ligands, channels, resolution, metric_df, metri
 
                     lig_fit = lig_grids['lig_fit'][i]
                     lig_gen_fit = lig_grids['lig_gen_fit'][i]
-                    lig_fit_xyz = lig_xyzs['lig_fit'][i]
-                    lig_gen_fit_xyz = lig_xyzs['lig_gen_fit'][i]
 
                     # fit density quality
                     metric_df.loc[(lig_name, i), 'lig_fit_dist']     = np.linalg.norm(lig_fit - lig)
                     metric_df.loc[(lig_name, i), 'lig_gen_fit_dist'] = np.linalg.norm(lig_gen_fit - lig_gen)
 
                     # fit structure quality
-                    metric_df.loc[(lig_name, i), 'lig_gen_RMSD'] = min_RMSD(lig_gen_fit_xyz, lig_fit_xyz, c)
+                    metric_df.loc[(lig_name, i), 'lig_gen_RMSD'] = lig_gen_RMSDs[i]
+
+                # atom fitting cost and budget hits
+                for grid_name, fit_stats in lig_fit_stats.items():
+                    metric_df.loc[(lig_name, i), grid_name + '_time']      = fit_stats[i]['time']
+                    metric_df.loc[(lig_name, i), grid_name + '_n_iters']   = fit_stats[i]['n_iters']
+                    metric_df.loc[(lig_name, i), grid_name + '_truncated'] = fit_stats[i]['truncated']
 
             #print(metric_df.loc[lig_name])
 
@@ -1016,6 +2187,7 @@ def parse_args(argv=None):
     parser.add_argument('-l', '--lig_file', default=[], action='append', help='ligand file (relative to data_root)')
     parser.add_argument('--data_file', default='', help='path to data file (generate for every example)')
     parser.add_argument('--data_root', default='', help='path to root for receptor and ligand files')
+    parser.add_argument('--lig_store', default='', help='prefix of packed ligand atoms to read instead of .gninatypes files (see pack_gninatypes.py)')
     parser.add_argument('-b', '--blob_name', default=[], action='append', help='blob(s) in model to generate from (default lig & lig_gen)')
     parser.add_argument('--n_samples', default=1, type=int, help='number of samples to generate for each input example')
     parser.add_argument('--prior', default=False, action='store_true', help='generate from prior instead of posterior distribution')
@@ -1031,6 +2203,20 @@ def parse_args(argv=None):
     parser.add_argument('--lambda_E', type=float, default=0.0, help='interatomic bond energy loss weight for gradient descent atom fitting')
     parser.add_argument('--bonded', action='store_true', help="add atoms by creating bonds to existing atoms when atom fitting")
     parser.add_argument('--max_init_bond_E', type=float, default=0.5, help='maximum energy of bonds to consider when adding bonded atoms')
+    parser.add_argument('--density_backend', default='piecewise', choices=sorted(density_backends), help='atom density function for atom fitting')
+    parser.add_argument('--max_batch_points', type=int, default=2**20, help='maximum number of atom-grid point pairs to evaluate at once in atom fitting')
+    parser.add_argument('--incremental_fit', action='store_true', help='only re-evaluate density of atoms that moved during gradient descent atom fitting')
+    parser.add_argument('--incremental_conv', action='store_true', help='update residual correlations for new atoms instead of recomputing them by FFT in atom fitting')
+    parser.add_argument('--multi_atom', action='store_true', help='place atoms at all correlation peaks in each outer iteration of atom fitting')
+    parser.add_argument('--optimizer', default='GD', choices=sorted(optimizers), help='optimizer of atom positions for atom fitting')
+    parser.add_argument('--coarsen_fit', default=1, type=int, help='factor to downsample grids by to place atoms before fitting at full resolution')
+    parser.add_argument('--fit_time_budget', type=float, default=np.inf, help='maximum seconds for fitting atoms to each grid, after which the best fit so far is used')
+    parser.add_argument('--fit_iter_budget', type=int, default=np.inf, help='maximum total optimizer iterations for fitting atoms to each grid')
+    parser.add_argument('--fit_cache_size', default=0, type=int, help='number of atom fitting results to cache in memory, shared by fit workers, so that identical grids are fit once')
+    parser.add_argument('--fit_cache_dir', help='directory to also cache atom fitting results in across runs')
+    parser.add_argument('--fit_cache_timeout', default=600.0, type=float, help='seconds to wait for another fit worker to fit an identical grid before fitting it anyway')
+    parser.add_argument('--batch_fit', action='store_true', help='fit atoms to all samples of each blob at once in lockstep, with default fitting options')
+    parser.add_argument('--max_batch_grids', default=4, type=int, help='maximum number of grids to fit at once in lockstep with --batch_fit')
     parser.add_argument('--fit_GMM', action='store_true', help='fit atoms by a Gaussian mixture model instead of gradient descent')
     parser.add_argument('--noise_model', default='', help='noise model for GMM atom fitting (d|p)')
     parser.add_argument('-r2', '--rec_file2', default='', help='alternate receptor file (for receptor latent space)')
@@ -1047,7 +2233,26 @@ def parse_args(argv=None):
     parser.add_argument('--use_covalent_radius', default=False, action='store_true', help='force input grid to use covalent radius')
     parser.add_argument('--use_default_radius', default=False, action='store_true', help='force input grid to use default radius')
     parser.add_argument('--n_fit_workers', default=mp.cpu_count(), type=int, help='number of worker processes for async atom fitting')
-    return parser.parse_args(argv)
+    args = parser.parse_args(argv)
+
+    if args.bonded and args.fit_atom_types:
+        parser.error('--bonded does not support --fit_atom_types')
+
+    if args.batch_fit: # lockstep fitting only supports the default fitting options
+        unsupported = [name for name, is_set in [
+            ('--lambda_E', args.lambda_E != 0.0),
+            ('--bonded', args.bonded),
+            ('--optimizer', args.optimizer != 'GD'),
+            ('--incremental_fit', args.incremental_fit),
+            ('--incremental_conv', args.incremental_conv),
+            ('--multi_atom', args.multi_atom),
+            ('--coarsen_fit', args.coarsen_fit != 1),
+            ('--deconv_fit', args.deconv_fit),
+        ] if is_set]
+        if unsupported:
+            parser.error('--batch_fit does not support {}'.format(', '.join(unsupported)))
+
+    return args
 
 
 def main(argv):
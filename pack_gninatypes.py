@@ -0,0 +1,23 @@
+from __future__ import print_function
+import sys, argparse
+
+import generate
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description='Pack the .gninatypes ligand files in a data file into one memory-mappable store')
+    parser.add_argument('-d', '--data_file', required=True, help='.types file of receptor and ligand files')
+    parser.add_argument('-r', '--data_root', default='', help='path to root for receptor and ligand files')
+    parser.add_argument('-o', '--out_prefix', required=True, help='prefix of packed store files to write')
+    return parser.parse_args(argv)
+
+
+def main(argv):
+    args = parse_args(argv)
+    generate.pack_gninatypes_files(args.data_file, args.data_root, args.out_prefix)
+    store = generate.load_gninatypes_store(args.out_prefix, args.data_root)
+    print('packed {} atoms from {} ligand files to {}'.format(len(store.atoms), len(store.index), args.out_prefix))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])